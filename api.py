@@ -1,19 +1,62 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
+from pydantic import BaseModel, Field, AliasChoices, AliasPath
 from typing import Optional
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from collections import OrderedDict
 import asyncio
-import uuid
+import json
 import time
 import os
+import tempfile
+import email.utils
+import random
 import httpx
+import orjson
 
-app = FastAPI(title="Jamef Rastreamento API", version="2.0.0")
+try:
+    import fcntl
+except ImportError:   # Windows: sem flock, cada processo mantém seu próprio token
+    fcntl = None
+
+from jobstore import Job, JobStore, MemoriaJobStore, SQLiteJobStore, RedisJobStore
+from metricas import Registro
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Abre o cliente HTTP compartilhado e as tasks de fundo; encerra tudo no desligamento."""
+    abrir_cliente_http()
+    tarefas = [
+        asyncio.create_task(renovar_token_periodicamente()),
+        asyncio.create_task(limpar_jobs_periodicamente()),
+        *fila_jobs.iniciar(),
+    ]
+    try:
+        yield
+    finally:
+        for t in tarefas:
+            t.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        await fechar_cliente_http()
+        await jobs.fechar()
+
+
+# ORJSONResponse: serializa as respostas com orjson em vez do json da stdlib
+app = FastAPI(
+    title="Jamef Rastreamento API",
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_methods=["GET"],
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
 
@@ -25,30 +68,333 @@ JAMEF_PASSWORD = os.getenv("JAMEF_PASSWORD", "")
 JAMEF_AUTH_URL  = os.getenv("JAMEF_AUTH_URL",  "https://api.jamef.com.br/auth/v1/login")
 JAMEF_RASTR_URL = os.getenv("JAMEF_RASTR_URL", "https://api.jamef.com.br/consulta/v1/rastreamento")
 
-# Cache do token JWT em memória
-_token: dict = {"value": None, "expires_at": 0.0}
+# Pool de conexões HTTP com a Jamef (keep-alive reaproveita TCP + TLS entre chamadas)
+JAMEF_TIMEOUT          = float(os.getenv("JAMEF_TIMEOUT", "30"))
+JAMEF_MAX_CONEXOES     = int(os.getenv("JAMEF_MAX_CONEXOES", "100"))
+JAMEF_MAX_KEEPALIVE    = int(os.getenv("JAMEF_MAX_KEEPALIVE", "20"))
+JAMEF_KEEPALIVE_EXPIRY = float(os.getenv("JAMEF_KEEPALIVE_EXPIRY", "30"))
+JAMEF_HTTP2            = os.getenv("JAMEF_HTTP2", "false").lower() in ("1", "true", "yes")
 
-# Storage in-memory de jobs { job_id: { status, result, error, created_at } }
-jobs: dict = {}
+# Limite de taxa das chamadas à Jamef (token bucket); JAMEF_RPS=0 desativa o
+# bucket. Respostas 429 pausam as chamadas pelo Retry-After (mesmo com
+# JAMEF_RPS=0) e a chamada volta para a fila; um Retry-After acima de
+# JAMEF_MAX_ESPERA_429 segundos não pausa nada e a chamada falha na hora.
+# O limite vale por processo: com --workers N a taxa real contra a Jamef chega a
+# N × JAMEF_RPS (e rajadas de N × JAMEF_RAJADA); divida pelo número de workers.
+JAMEF_RPS            = float(os.getenv("JAMEF_RPS", "10"))
+JAMEF_RAJADA         = int(os.getenv("JAMEF_RAJADA", "10"))
+JAMEF_MAX_429        = int(os.getenv("JAMEF_MAX_429", "5"))
+JAMEF_ESPERA_429     = float(os.getenv("JAMEF_ESPERA_429", "5"))   # sem Retry-After
+JAMEF_MAX_ESPERA_429 = float(os.getenv("JAMEF_MAX_ESPERA_429", "60"))
 
+# Circuit breaker da Jamef: abre após CB_MAX_FALHAS falhas seguidas ou latência
+# média acima de CB_LATENCIA_MAX; fica aberto CB_ABERTO_SEGUNDOS e então deixa
+# passar até CB_SONDAS chamadas de teste (meio-aberto) antes de fechar de novo
+CB_MAX_FALHAS      = int(os.getenv("CB_MAX_FALHAS", "5"))
+CB_LATENCIA_MAX    = float(os.getenv("CB_LATENCIA_MAX", "10"))
+CB_ABERTO_SEGUNDOS = float(os.getenv("CB_ABERTO_SEGUNDOS", "30"))
+CB_SONDAS          = int(os.getenv("CB_SONDAS", "1"))
+
+# Retentativas do GET de rastreamento (idempotente) em falhas transitórias:
+# backoff exponencial com jitter total, limitado por tentativas e por tempo
+RETRY_MAX_TENTATIVAS = int(os.getenv("RETRY_MAX_TENTATIVAS", "4"))
+RETRY_BASE           = float(os.getenv("RETRY_BASE", "0.5"))
+RETRY_MAX_ESPERA     = float(os.getenv("RETRY_MAX_ESPERA", "8"))
+RETRY_ORCAMENTO      = float(os.getenv("RETRY_ORCAMENTO", "20"))
+
+# Token JWT: renova quando faltam menos de TOKEN_MARGEM segundos; a task de
+# fundo se antecipa mais TOKEN_ANTECEDENCIA segundos. Para tokens de vida curta
+# as duas ficam limitadas a uma fração da validade (expiresIn) do token
+TOKEN_MARGEM              = 300
+TOKEN_ANTECEDENCIA        = float(os.getenv("TOKEN_ANTECEDENCIA", "60"))
+TOKEN_MARGEM_FRACAO       = 0.2
+TOKEN_ANTECEDENCIA_FRACAO = 0.1
+TOKEN_ESPERA_FALHA        = float(os.getenv("TOKEN_ESPERA_FALHA", "30"))
+
+# Token compartilhado entre workers num arquivo protegido por flock; só um
+# processo faz login por vez e os demais reaproveitam o token gravado.
+# Defina TOKEN_CACHE_PATH="" para desativar.
+TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH", os.path.join(tempfile.gettempdir(), "jamef_token.json"))
+
+# Cache do token JWT em memória (refresh = login em andamento, compartilhado;
+# recusado = último token que a Jamef respondeu com 401; vida = expiresIn)
+_token: dict = {"value": None, "expires_at": 0.0, "vida": 0.0, "refresh": None, "recusado": None}
+
+# Cache de resultados por (cnpj, nf): TTL curto em trânsito, longo após a entrega
+CACHE_MAX_ENTRADAS = int(os.getenv("CACHE_MAX_ENTRADAS", "5000"))
+CACHE_TTL_TRANSITO = float(os.getenv("CACHE_TTL_TRANSITO", "300"))
+CACHE_TTL_ENTREGUE = float(os.getenv("CACHE_TTL_ENTREGUE", "86400"))
+
+# Stale-while-revalidate: por até CACHE_STALE_JANELA segundos após expirar, o
+# resultado é devolvido na hora (stale=true) e atualizado em background
+CACHE_STALE_JANELA = float(os.getenv("CACHE_STALE_JANELA", "300"))
+
+# Cliente HTTP compartilhado por toda a aplicação (criado no lifespan)
+_http: dict = {"client": None}
+
+# Storage de jobs: backend (memoria | sqlite | redis), expiração por idade e
+# limites de entradas e de memória. Com --workers > 1 use sqlite ou redis.
+JOBS_BACKEND          = os.getenv("JOBS_BACKEND", "memoria").lower()
+JOBS_SQLITE_PATH      = os.getenv("JOBS_SQLITE_PATH", "jobs.sqlite3")
+JOBS_REDIS_URL        = os.getenv("JOBS_REDIS_URL", "redis://localhost:6379/0")
+JOB_TTL               = float(os.getenv("JOB_TTL", "3600"))
+JOB_LIMPEZA_INTERVALO = float(os.getenv("JOB_LIMPEZA_INTERVALO", "60"))
+JOBS_MAX_ENTRADAS     = int(os.getenv("JOBS_MAX_ENTRADAS", "20000"))
+JOBS_MAX_BYTES        = int(os.getenv("JOBS_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# Long-polling em /status: tempo máximo que uma requisição pode ficar aguardando
+STATUS_MAX_WAIT       = float(os.getenv("STATUS_MAX_WAIT", "30"))
+STATUS_POLL_INTERVALO = float(os.getenv("STATUS_POLL_INTERVALO", "0.25"))   # jobs de outro worker
+
+# Modo síncrono de /rastrear: prazo padrão e máximo para responder inline
+SYNC_TIMEOUT_PADRAO = float(os.getenv("SYNC_TIMEOUT_PADRAO", "10"))
+SYNC_MAX_TIMEOUT    = float(os.getenv("SYNC_MAX_TIMEOUT", "30"))
+
+# Rastreamento em lote: NFs consultadas em paralelo por lote e tamanho máximo
+LOTE_CONCORRENCIA = int(os.getenv("LOTE_CONCORRENCIA", "10"))
+LOTE_MAX_NFS      = int(os.getenv("LOTE_MAX_NFS", "1000"))
+LOTE_PROGRESSO_INTERVALO = float(os.getenv("LOTE_PROGRESSO_INTERVALO", "1"))
+
+# WebSocket: mensagens pendentes por conexão antes de descartar (cliente lento)
+WS_MAX_PENDENTES = int(os.getenv("WS_MAX_PENDENTES", "1000"))
+
+# Fila de jobs de /rastrear: workers que consomem a fila, tamanho máximo antes
+# de recusar com 503 e o Retry-After sugerido nessa resposta
+FILA_WORKERS     = int(os.getenv("FILA_WORKERS", "20"))
+FILA_MAX         = int(os.getenv("FILA_MAX", "1000"))
+FILA_RETRY_AFTER = int(os.getenv("FILA_RETRY_AFTER", "5"))
+
+# Deduplicação de trabalho em andamento por (cnpj, nf)
+jobs_em_andamento: dict = {}        # (cnpj, nf) -> job_id ainda em "processing"
+_consultas_em_andamento: dict = {}  # (cnpj, nf) -> task compartilhada da consulta
+
+
+# ── Armazenamento de jobs ─────────────────────────────────────────────────────
+
+def criar_job_store() -> JobStore:
+    """Instancia o backend escolhido em JOBS_BACKEND (memoria | sqlite | redis)."""
+    if JOBS_BACKEND == "sqlite":
+        return SQLiteJobStore(JOBS_SQLITE_PATH, JOB_TTL, JOBS_MAX_ENTRADAS, JOBS_MAX_BYTES)
+    if JOBS_BACKEND == "redis":
+        return RedisJobStore(JOBS_REDIS_URL, JOB_TTL, JOBS_MAX_ENTRADAS, JOBS_MAX_BYTES)
+    return MemoriaJobStore(JOB_TTL, JOBS_MAX_ENTRADAS, JOBS_MAX_BYTES)
+
+
+jobs = criar_job_store()
+
+
+async def limpar_jobs_periodicamente():
+    """Varre os jobs expirados a cada JOB_LIMPEZA_INTERVALO segundos."""
+    while True:
+        await asyncio.sleep(JOB_LIMPEZA_INTERVALO)
+        try:
+            await jobs.limpar_expirados()
+        except Exception:
+            pass   # backend indisponível: tenta de novo na próxima varredura
+
+
+# ── Cliente HTTP compartilhado ────────────────────────────────────────────────
+
+def _http2_disponivel() -> bool:
+    """HTTP/2 no httpx depende do pacote `h2` (está no requirements.txt)."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def abrir_cliente_http() -> httpx.AsyncClient:
+    """Cria o cliente HTTP compartilhado com pool de conexões keep-alive."""
+    if _http["client"] is None or _http["client"].is_closed:
+        if JAMEF_HTTP2 and not _http2_disponivel():
+            raise RuntimeError("JAMEF_HTTP2=true requer o pacote `h2` (pip install httpx[http2])")
+        _http["client"] = httpx.AsyncClient(
+            timeout=JAMEF_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=JAMEF_MAX_CONEXOES,
+                max_keepalive_connections=JAMEF_MAX_KEEPALIVE,
+                keepalive_expiry=JAMEF_KEEPALIVE_EXPIRY,
+            ),
+            http2=JAMEF_HTTP2,
+        )
+    return _http["client"]
+
+
+async def fechar_cliente_http():
+    client = _http["client"]
+    _http["client"] = None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+
+def cliente_http() -> httpx.AsyncClient:
+    """Retorna o cliente compartilhado, criando-o se o lifespan ainda não rodou."""
+    return abrir_cliente_http()
 
-def limpar_jobs_antigos():
-    """Remove jobs com mais de 1 hora para evitar vazamento de memória."""
-    agora = time.time()
-    expirados = [jid for jid, j in jobs.items() if agora - j["created_at"] > 3600]
-    for jid in expirados:
-        del jobs[jid]
+
+# ── Cache de resultados ───────────────────────────────────────────────────────
+
+def foi_entregue(status_atual: Optional[str]) -> bool:
+    """Indica se o status final do rastreamento é de entrega concluída."""
+    if not status_atual:
+        return False
+    s = status_atual.upper()
+    if "NAO ENTREGUE" in s or "NÃO ENTREGUE" in s:
+        return False
+    return "ENTREGUE" in s or "ENTREGA REALIZADA" in s
+
+
+class CacheResultados:
+    """Cache LRU com TTL por entrada para resultados de consultar_jamef()."""
+
+    def __init__(self, max_entradas: int, ttl_transito: float, ttl_entregue: float):
+        self.max_entradas = max_entradas
+        self.ttl_transito = ttl_transito
+        self.ttl_entregue = ttl_entregue
+        self._dados: OrderedDict = OrderedDict()   # chave -> (expires_at, fetched_at, resultado)
+        self.hits       = 0
+        self.stale_hits = 0
+        self.misses     = 0
+
+    def get(self, chave: tuple, janela_stale: float = 0.0) -> Optional[tuple["ResultadoRastreamento", float, bool]]:
+        """
+        Retorna (resultado, fetched_at, fresco) ou None. Entradas expiradas há
+        menos de `janela_stale` segundos voltam com fresco=False.
+        """
+        item = self._dados.get(chave)
+        agora = time.time()
+        if item is None or agora >= item[0] + janela_stale:
+            # Expirados ficam guardados (até sair pelo LRU) para get_stale()
+            self.misses += 1
+            return None
+        self._dados.move_to_end(chave)
+        fresco = agora < item[0]
+        if fresco:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return item[2], item[1], fresco
+
+    def get_stale(self, chave: tuple) -> Optional[tuple["ResultadoRastreamento", float]]:
+        """Último resultado conhecido e quando foi obtido, mesmo que expirado."""
+        item = self._dados.get(chave)
+        if item is None:
+            return None
+        return item[2], item[1]
+
+    def set(self, chave: tuple, resultado: "ResultadoRastreamento"):
+        agora = time.time()
+        ttl = self.ttl_entregue if foi_entregue(resultado.status_atual) else self.ttl_transito
+        self._dados[chave] = (agora + ttl, agora, resultado)
+        self._dados.move_to_end(chave)
+        while len(self._dados) > self.max_entradas:
+            self._dados.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.stale_hits + self.misses
+        return {
+            "entradas":     len(self._dados),
+            "max_entradas": self.max_entradas,
+            "hits":         self.hits,
+            "stale_hits":   self.stale_hits,
+            "misses":       self.misses,
+            "hit_ratio":    round((self.hits + self.stale_hits) / total, 4) if total else 0.0,
+        }
+
+
+cache_resultados = CacheResultados(CACHE_MAX_ENTRADAS, CACHE_TTL_TRANSITO, CACHE_TTL_ENTREGUE)
+
+
+# ── Notificações em tempo real (WebSocket) ────────────────────────────────────
+
+# tópico ("job:<id>" ou "nf:<cnpj>:<nf>") -> filas das conexões assinantes
+assinantes: dict = {}
+
+
+def topico_nf(cnpj: str, numero_nf: str) -> str:
+    return f"nf:{cnpj}:{numero_nf}"
+
+
+def publicar(topico: str, mensagem: dict):
+    """Entrega a mensagem a todas as conexões assinantes do tópico, sem bloquear."""
+    for fila in assinantes.get(topico, ()):
+        try:
+            fila.put_nowait(mensagem)
+        except asyncio.QueueFull:
+            pass   # conexão lenta demais: descarta em vez de segurar o job
+
+
+def assinar(topico: str, fila: asyncio.Queue):
+    assinantes.setdefault(topico, set()).add(fila)
+
+
+def cancelar_assinatura(topico: str, fila: asyncio.Queue):
+    filas = assinantes.get(topico)
+    if filas is not None:
+        filas.discard(fila)
+        if not filas:
+            del assinantes[topico]
+
+
+def ler_mensagem_ws(texto: str | bytes) -> tuple[str, list[str], list[str]]:
+    """
+    Valida uma mensagem do cliente WebSocket e devolve (ação, job_ids, tópicos).
+    Qualquer formato inesperado vira ValueError com a descrição do problema.
+    """
+    try:
+        msg = orjson.loads(texto)
+    except orjson.JSONDecodeError:
+        raise ValueError("mensagem não é um JSON válido") from None
+    if not isinstance(msg, dict):
+        raise ValueError("mensagem deve ser um objeto JSON")
+    acao = msg.get("acao")
+    if acao not in ("assinar", "cancelar"):
+        raise ValueError(f"ação desconhecida: {acao}")
+
+    job_ids = msg.get("jobs", [])
+    if not isinstance(job_ids, list) or not all(isinstance(j, str) for j in job_ids):
+        raise ValueError('"jobs" deve ser uma lista de job_ids')
+    nfs = msg.get("nfs", [])
+    if not isinstance(nfs, list):
+        raise ValueError('"nfs" deve ser uma lista')
+
+    topicos = [f"job:{jid}" for jid in job_ids]
+    for n in nfs:
+        if not isinstance(n, dict) or not isinstance(n.get("numero_nf"), str):
+            raise ValueError('cada item de "nfs" precisa de "numero_nf" (string)')
+        topicos.append(topico_nf(n.get("cnpj") or CNPJ_PADRAO, n["numero_nf"]))
+    return acao, job_ids, topicos
+
+
+def mensagem_job(job: "Job") -> dict:
+    return {
+        "tipo":   "job",
+        "job_id": job.job_id,
+        "status": job.status,
+        "result": job.result,
+        "error":  job.error,
+    }
+
+
+def mensagem_nf(numero_nf: str, cnpj: str, status: str, result, error: Optional[str]) -> dict:
+    return {"tipo": "nf", "nf": numero_nf, "cnpj": cnpj, "status": status, "result": result, "error": error}
 
 
 # ── Modelos ───────────────────────────────────────────────────────────────────
 
+def _local(campo: str, local: str, chave: str):
+    """Aceita o nome do nosso campo ou o caminho equivalente no payload da Jamef."""
+    return Field(None, validation_alias=AliasChoices(campo, AliasPath(local, chave)))
+
+
 class EventoHistorico(BaseModel):
-    data: Optional[str]
-    status: Optional[str]
-    estado_origem: Optional[str]
-    municipio_origem: Optional[str]
-    estado_destino: Optional[str]
-    municipio_destino: Optional[str]
+    data: Optional[str] = None
+    status: Optional[str] = None
+    estado_origem: Optional[str] = _local("estado_origem", "localOrigem", "uf")
+    municipio_origem: Optional[str] = _local("municipio_origem", "localOrigem", "cidade")
+    estado_destino: Optional[str] = _local("estado_destino", "localDestino", "uf")
+    municipio_destino: Optional[str] = _local("municipio_destino", "localDestino", "cidade")
 
 class ResultadoRastreamento(BaseModel):
     nf: str
@@ -57,6 +403,30 @@ class ResultadoRastreamento(BaseModel):
     previsao_entrega: Optional[str]
     status_atual: Optional[str]
     historico: list[EventoHistorico]
+    stale: bool = False                # True = resultado expirado servido do cache
+    fetched_at: Optional[str] = None   # quando o resultado foi obtido da Jamef (ISO 8601)
+
+# Formato da resposta de /consulta/v1/rastreamento (só os campos usados). Os
+# eventos já são validados direto como EventoHistorico, numa única passada
+# sobre os bytes da resposta.
+class _LocalJamef(BaseModel):
+    cidade: Optional[str] = None
+    uf: Optional[str] = None
+
+class _FreteJamef(BaseModel):
+    previsaoEntrega: Optional[str] = None
+
+class _RastreamentoJamef(BaseModel):
+    remetente: Optional[_LocalJamef] = None
+    destinatario: Optional[_LocalJamef] = None
+    frete: Optional[_FreteJamef] = None
+    eventosRastreio: list[EventoHistorico] = []
+
+class _DadoJamef(BaseModel):
+    rastreamento: list[_RastreamentoJamef] = []
+
+class _RespostaJamef(BaseModel):
+    dado: list[_DadoJamef] = []
 
 class JobIniciado(BaseModel):
     job_id: str
@@ -68,95 +438,884 @@ class JobStatus(BaseModel):
     status: str          # "processing" | "done" | "error"
     result: Optional[ResultadoRastreamento] = None
     error: Optional[str] = None
+    tentativas: Optional[int] = None   # GETs enviados à Jamef, com 429/401/retentativas (0 = cache)
+    timings: Optional[dict[str, float]] = None   # ms por fase: fila, auth, upstream, parse, total
+
+class ItemLote(BaseModel):
+    numero_nf: str
+    cnpj: Optional[str] = None   # usa o cnpj do lote se omitido
+
+class LoteRequest(BaseModel):
+    nfs: list[ItemLote | str]
+    cnpj: str = CNPJ_PADRAO
+
+class ItemLoteStatus(BaseModel):
+    nf: str
+    cnpj: str
+    status: str          # "processing" | "done" | "error"
+    result: Optional[ResultadoRastreamento] = None
+    error: Optional[str] = None
+
+class LoteStatus(BaseModel):
+    job_id: str
+    status: str          # "processing" | "done"
+    total: int
+    concluidos: int
+    erros: int
+    itens: list[ItemLoteStatus]
+
+
+# ── Métricas (/metrics) ───────────────────────────────────────────────────────
+
+metricas = Registro()
+
+latencia_upstream = metricas.histograma(
+    "jamef_upstream_latencia_segundos", "Latência das chamadas HTTP à Jamef, por operação (auth|rastreamento)",
+)
+upstream_em_andamento = metricas.gauge(
+    "jamef_upstream_em_andamento", "Chamadas HTTP à Jamef em andamento neste worker",
+)
+renovacoes_token = metricas.contador(
+    "jamef_token_renovacoes_total", "Renovações de token (origem=login|compartilhado, resultado=ok|erro)",
+)
+cache_consultas = metricas.contador(
+    "jamef_cache_consultas_total", "Consultas ao cache de resultados (resultado=hit|stale|miss)",
+    funcao=lambda: {
+        (("resultado", "hit"),):   cache_resultados.hits,
+        (("resultado", "stale"),): cache_resultados.stale_hits,
+        (("resultado", "miss"),):  cache_resultados.misses,
+    },
+)
+jobs_finalizados = metricas.contador(
+    "jamef_jobs_finalizados_total", "Jobs finalizados neste worker (tipo=nf|lote, status=done|error)",
+)
+# Lidos do job store só no scrape; ver metrics()
+jobs_processing = metricas.gauge("jamef_jobs_processing", "Jobs em \"processing\" no job store")
+jobs_entradas   = metricas.gauge("jamef_jobs_entradas", "Total de jobs no job store")
+jobs_bytes      = metricas.gauge("jamef_jobs_bytes", "Bytes estimados ocupados pelo job store")
+fila_profundidade = metricas.gauge(
+    "jamef_fila_profundidade", "Jobs aguardando um worker na fila de /rastrear",
+    funcao=lambda: {(): fila_jobs.fila.qsize()},
+)
+fila_espera = metricas.histograma(
+    "jamef_fila_espera_segundos", "Tempo entre enfileirar o job e um worker começar a executá-lo",
+)
+fila_recusados = metricas.contador(
+    "jamef_fila_recusados_total", "Jobs recusados com 503 por fila cheia",
+)
+
+
+# ── Limite de taxa ────────────────────────────────────────────────────────────
+
+class LimitadorTaxa:
+    """
+    Token bucket assíncrono: libera até `taxa` chamadas/s com rajadas de até
+    `rajada`. Quem chega sem ficha espera na fila (FIFO via Lock) em vez de falhar.
+    """
+
+    def __init__(self, taxa: float, rajada: int):
+        self.taxa         = taxa
+        self.rajada       = max(1, rajada)
+        self._fichas      = float(self.rajada)
+        self._atualizado  = time.monotonic()
+        self._pausado_ate = 0.0
+        self._lock        = asyncio.Lock()
+        self.esperas      = 0   # chamadas que precisaram aguardar
+        self.pausas_429   = 0
+
+    async def adquirir(self):
+        if self.taxa <= 0:
+            # Sem bucket, mas a pausa pedida por um 429 continua valendo
+            esperou = False
+            while (restante := self._pausado_ate - time.monotonic()) > 0:
+                esperou = True
+                await asyncio.sleep(restante)
+            self.esperas += esperou
+            return
+        async with self._lock:
+            esperou = False
+            while True:
+                agora = time.monotonic()
+                if agora < self._pausado_ate:
+                    esperou = True
+                    await asyncio.sleep(self._pausado_ate - agora)
+                    continue
+                self._fichas = min(self.rajada, self._fichas + (agora - self._atualizado) * self.taxa)
+                self._atualizado = agora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    self.esperas += esperou
+                    return
+                esperou = True
+                await asyncio.sleep((1 - self._fichas) / self.taxa)
+
+    def pausar(self, segundos: float):
+        """Segura todas as chamadas por `segundos` (Retry-After de um 429)."""
+        self._pausado_ate = max(self._pausado_ate, time.monotonic() + segundos)
+        # Balde vazio no fim da pausa: a reposição recomeça só a partir dali,
+        # sem liberar uma rajada inteira logo após o Retry-After
+        self._fichas     = 0.0
+        self._atualizado = self._pausado_ate
+        self.pausas_429 += 1
+
+
+limitador = LimitadorTaxa(JAMEF_RPS, JAMEF_RAJADA)
+
+
+# ── Circuit breaker ───────────────────────────────────────────────────────────
+
+class CircuitoAberto(Exception):
+    """A Jamef está marcada como indisponível: a chamada falha sem ir à rede."""
+
+
+class CircuitBreaker:
+    """
+    Estados: "fechado" (normal) → "aberto" (falha na hora) → "meio-aberto"
+    (deixa passar `sondas` chamadas de teste; sucesso fecha, falha reabre).
+    """
+
+    ALFA_LATENCIA = 0.2   # peso da última amostra na média móvel de latência
+
+    def __init__(self, max_falhas: int, latencia_max: float, aberto_por: float, sondas: int):
+        self.max_falhas      = max_falhas
+        self.latencia_max    = latencia_max
+        self.aberto_por      = aberto_por
+        self.sondas          = max(1, sondas)
+        self.estado          = "fechado"
+        self.falhas_seguidas = 0
+        self.latencia_media  = None
+        self.aberto_ate      = 0.0
+        self._sondas_em_voo  = 0
+        self.aberturas       = 0
+        self.rejeitadas      = 0
+
+    def permitir(self) -> bool:
+        """
+        Levanta CircuitoAberto se a chamada não deve ir à Jamef agora. Devolve
+        True se a chamada é uma sonda do meio-aberto (repassar a registrar()).
+        """
+        if self.estado == "aberto":
+            restante = self.aberto_ate - time.monotonic()
+            if restante > 0:
+                self.rejeitadas += 1
+                raise CircuitoAberto(f"Jamef indisponível; nova tentativa em {restante:.0f}s")
+            self.estado = "meio-aberto"
+            self._sondas_em_voo = 0
+        if self.estado == "meio-aberto":
+            if self._sondas_em_voo >= self.sondas:
+                self.rejeitadas += 1
+                raise CircuitoAberto("Jamef indisponível; aguardando chamada de teste")
+            self._sondas_em_voo += 1
+            return True
+        return False
+
+    def registrar(self, sucesso: Optional[bool], latencia: Optional[float] = None, sonda: bool = False):
+        """
+        Registra o desfecho de uma chamada liberada por permitir(). Só sondas
+        decidem o meio-aberto: uma chamada liberada com o circuito fechado que
+        termina depois de ele abrir não fecha nem reabre nada.
+        """
+        sonda = sonda and self.estado == "meio-aberto"
+        if sonda:
+            self._sondas_em_voo = max(0, self._sondas_em_voo - 1)
+        if sucesso is None or (self.estado != "fechado" and not sonda):
+            return
+        if not sucesso:
+            self.falhas_seguidas += 1
+            if sonda or self.falhas_seguidas >= self.max_falhas:
+                self._abrir()
+            return
+
+        self.falhas_seguidas = 0
+        if sonda:
+            self.estado = "fechado"
+            self.latencia_media = latencia
+            return
+        if latencia is not None:
+            if self.latencia_media is None:
+                self.latencia_media = latencia
+            else:
+                self.latencia_media += self.ALFA_LATENCIA * (latencia - self.latencia_media)
+            if self.estado == "fechado" and self.latencia_media > self.latencia_max:
+                self._abrir()
+
+    def _abrir(self):
+        self.estado     = "aberto"
+        self.aberto_ate = time.monotonic() + self.aberto_por
+        self.aberturas += 1
+
+    def stats(self) -> dict:
+        return {
+            "estado":          self.estado,
+            "falhas_seguidas": self.falhas_seguidas,
+            "latencia_media":  round(self.latencia_media, 4) if self.latencia_media is not None else None,
+            "aberturas":       self.aberturas,
+            "rejeitadas":      self.rejeitadas,
+        }
+
+
+circuito = CircuitBreaker(CB_MAX_FALHAS, CB_LATENCIA_MAX, CB_ABERTO_SEGUNDOS, CB_SONDAS)
+
+
+def retry_after_segundos(resp: httpx.Response, padrao: float) -> float:
+    """Interpreta o header Retry-After (segundos ou data HTTP)."""
+    valor = resp.headers.get("Retry-After")
+    if not valor:
+        return padrao
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return padrao
+
+
+async def _requisitar(method: str, url: str, **kwargs) -> httpx.Response:
+    """Uma chamada à Jamef passando pelo circuit breaker e pelo limite de taxa."""
+    sonda     = circuito.permitir()
+    operacao  = "auth" if url == JAMEF_AUTH_URL else "rastreamento"
+    resultado = None   # None = neutro (não conta nem como sucesso nem como falha)
+    latencia  = None
+    try:
+        await limitador.adquirir()
+        if operacao == "rastreamento":
+            contar_chamada()
+        inicio = time.monotonic()
+        upstream_em_andamento.inc()
+        try:
+            resp = await cliente_http().request(method, url, **kwargs)
+        finally:
+            decorrido = time.monotonic() - inicio
+            upstream_em_andamento.dec()
+            latencia_upstream.observar(decorrido, operacao=operacao)
+        latencia = decorrido
+        if resp.status_code >= 500:
+            resultado = False
+        elif resp.status_code != 429:
+            resultado = True
+        return resp
+    except httpx.TransportError:
+        resultado = False
+        raise
+    finally:
+        circuito.registrar(resultado, latencia, sonda)
+
+
+async def chamar_jamef(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Faz a chamada respeitando o limite de taxa; 429 volta para a fila até
+    JAMEF_MAX_429 vezes. Um Retry-After maior que JAMEF_MAX_ESPERA_429 devolve
+    o próprio 429: pausar seguraria todas as chamadas do processo, login incluso.
+    """
+    for _ in range(JAMEF_MAX_429):
+        resp = await _requisitar(method, url, **kwargs)
+        if resp.status_code != 429:
+            return resp
+        espera = retry_after_segundos(resp, JAMEF_ESPERA_429)
+        if espera > JAMEF_MAX_ESPERA_429:
+            return resp
+        limitador.pausar(espera)
+    return await _requisitar(method, url, **kwargs)
 
 
 # ── Autenticação com cache ────────────────────────────────────────────────────
 
-async def obter_token() -> str:
-    """Retorna token JWT válido, renovando automaticamente se necessário."""
+async def _login_jamef() -> str:
+    """Faz o POST de login na Jamef e atualiza o cache do token."""
     agora = time.time()
-    # Reutiliza token se ainda válido por mais de 5 minutos
-    if _token["value"] and agora < _token["expires_at"] - 300:
-        return _token["value"]
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(
+    try:
+        resp = await chamar_jamef(
+            "POST",
             JAMEF_AUTH_URL,
             json={"username": JAMEF_USERNAME, "password": JAMEF_PASSWORD},
             headers={"Content-Type": "application/json"},
         )
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         token      = data["dado"][0]["accessToken"]
         expires_in = data["dado"][0].get("expiresIn", 3600)
-        _token["value"]      = token
-        _token["expires_at"] = agora + expires_in
+    except Exception:
+        renovacoes_token.inc(origem="login", resultado="erro")
+        raise
+    renovacoes_token.inc(origem="login", resultado="ok")
+    _token["value"]      = token
+    _token["expires_at"] = agora + expires_in
+    _token["vida"]       = expires_in
+    return token
+
+
+def margem_token(vida: float) -> float:
+    """Segundos antes da expiração em que o token deixa de ser usado."""
+    return min(TOKEN_MARGEM, vida * TOKEN_MARGEM_FRACAO)
+
+
+def inicio_renovacao() -> float:
+    """Instante (time.time) em que a task de fundo deve renovar o token atual."""
+    vida = _token["vida"]
+    antecedencia = min(TOKEN_ANTECEDENCIA, vida * TOKEN_ANTECEDENCIA_FRACAO)
+    return _token["expires_at"] - margem_token(vida) - antecedencia
+
 
-    return _token["value"]
+def _travar_arquivo_token() -> int:
+    """Abre o arquivo de lock e bloqueia até obter o flock exclusivo (roda numa thread)."""
+    fd = os.open(TOKEN_CACHE_PATH + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def _ler_token_compartilhado() -> Optional[dict]:
+    try:
+        with open(TOKEN_CACHE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _gravar_token_compartilhado():
+    """Grava o token atual de forma atômica (arquivo temporário + rename), legível só pelo dono."""
+    tmp = f"{TOKEN_CACHE_PATH}.{os.getpid()}.tmp"
+    fd  = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"value": _token["value"], "expires_at": _token["expires_at"], "vida": _token["vida"]}, f)
+    os.replace(tmp, TOKEN_CACHE_PATH)
+
+
+async def _login() -> str:
+    """
+    Obtém um token novo. Com o cache compartilhado ativo, segura o flock entre
+    workers: se outro processo já renovou, adota o token dele sem fazer login.
+    """
+    if not TOKEN_CACHE_PATH or fcntl is None:
+        return await _login_jamef()
+
+    fd = await asyncio.to_thread(_travar_arquivo_token)
+    try:
+        outro = _ler_token_compartilhado()
+        # Arquivos gravados antes de existir "vida": estima pelo tempo restante
+        vida_outro = outro.get("vida", outro.get("expires_at", 0) - time.time()) if outro else 0.0
+        if (
+            outro
+            and outro.get("value")
+            and outro["value"] != _token["recusado"]
+            and outro["expires_at"] > _token["expires_at"]
+            and time.time() < outro["expires_at"] - margem_token(vida_outro)
+        ):
+            _token["value"]      = outro["value"]
+            _token["expires_at"] = outro["expires_at"]
+            _token["vida"]       = vida_outro
+            renovacoes_token.inc(origem="compartilhado", resultado="ok")
+            return _token["value"]
+
+        token = await _login_jamef()
+        try:
+            _gravar_token_compartilhado()
+        except OSError:
+            pass   # sem disco gravável: segue só com o cache em memória
+        return token
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+async def renovar_token() -> str:
+    """
+    Renova o token garantindo um único login em andamento (single-flight):
+    chamadas concorrentes aguardam a mesma task em vez de disparar novos POSTs.
+    """
+    task = _token["refresh"]
+    if task is None or task.done():
+        task = asyncio.ensure_future(_login())
+        _token["refresh"] = task
+    # shield: o cancelamento de um chamador não derruba o login dos demais
+    return await asyncio.shield(task)
+
+
+async def obter_token() -> str:
+    """Retorna token JWT válido, renovando automaticamente se necessário."""
+    # Reutiliza token se ainda válido por mais que a margem de segurança
+    if _token["value"] and time.time() < _token["expires_at"] - margem_token(_token["vida"]):
+        return _token["value"]
+    return await renovar_token()
+
+
+def invalidar_token(token: str):
+    """Descarta o token em cache se ainda for o recusado pela Jamef."""
+    _token["recusado"] = token
+    if _token["value"] == token:
+        _token["value"]      = None
+        _token["expires_at"] = 0.0
+
+
+async def renovar_token_periodicamente():
+    """Renova o token antes da margem de segurança para nenhuma requisição esperar login."""
+    while True:
+        espera = inicio_renovacao() - time.time()
+        if espera > 0:
+            await asyncio.sleep(espera)
+        try:
+            await renovar_token()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Falha de login não derruba a task; tenta de novo mais tarde
+            await asyncio.sleep(TOKEN_ESPERA_FALHA)
+            continue
+        # Token que já nasce dentro da janela de renovação (expiresIn ~0 ou
+        # adotado perto do fim): espera em vez de fazer logins em sequência
+        if inicio_renovacao() <= time.time():
+            await asyncio.sleep(TOKEN_ESPERA_FALHA)
 
 
 # ── Consulta à API oficial Jamef ──────────────────────────────────────────────
 
-async def consultar_jamef(numero_nf: str, cnpj: str) -> dict:
-    token = await obter_token()
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(
-            JAMEF_RASTR_URL,
-            params={
-                "documentoRemetente": cnpj,
-                "numeroNotaFiscal":   numero_nf,
-            },
-            headers={"Authorization": f"Bearer {token}"},
-        )
-        resp.raise_for_status()
+# Detalhes da consulta em andamento (ex.: tentativas), lidos por quem a disparou
+_consulta_info: ContextVar[Optional[dict]] = ContextVar("consulta_info", default=None)
+
+# Falhas de rede em que a requisição com certeza não chegou à Jamef
+RETRY_EXCECOES = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+def registrar_consulta(**valores):
+    info = _consulta_info.get()
+    if info is not None:
+        info.update(valores)
+
+
+def contar_chamada():
+    """Soma ao info da consulta uma requisição de rastreamento de fato enviada à Jamef."""
+    info = _consulta_info.get()
+    if info is not None:
+        info["tentativas"] = info.get("tentativas", 0) + 1
+
+
+def registrar_tempo(fase: str, inicio: float):
+    """Soma ao info da consulta os ms gastos na fase desde `inicio` (time.monotonic)."""
+    info = _consulta_info.get()
+    if info is not None:
+        timings = info.setdefault("timings", {})
+        timings[fase] = timings.get(fase, 0.0) + (time.monotonic() - inicio) * 1000
+
+
+def server_timing(timings: Optional[dict]) -> dict:
+    """Header Server-Timing com as fases do job, para o DevTools e afins."""
+    if not timings:
+        return {}
+    return {"Server-Timing": ", ".join(f"{fase};dur={ms}" for fase, ms in timings.items())}
+
+
+async def _get_rastreamento(numero_nf: str, cnpj: str, token: str) -> httpx.Response:
+    return await chamar_jamef(
+        "GET",
+        JAMEF_RASTR_URL,
+        params={
+            "documentoRemetente": cnpj,
+            "numeroNotaFiscal":   numero_nf,
+        },
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+async def _get_cronometrado(numero_nf: str, cnpj: str) -> tuple[httpx.Response, str]:
+    inicio = time.monotonic()
+    try:
+        token = await obter_token()
+    finally:
+        # Também em falha: um login lento que termina em erro é o caso a diagnosticar
+        registrar_tempo("auth", inicio)
+    inicio = time.monotonic()
+    try:
+        return await _get_rastreamento(numero_nf, cnpj, token), token
+    finally:
+        registrar_tempo("upstream", inicio)
+
+
+async def _get_autenticado(numero_nf: str, cnpj: str) -> httpx.Response:
+    resp, token = await _get_cronometrado(numero_nf, cnpj)
+
+    # Token recusado (revogado/expirado antes do previsto): renova e tenta uma vez
+    if resp.status_code == 401:
+        invalidar_token(token)
+        resp, _ = await _get_cronometrado(numero_nf, cnpj)
+    return resp
+
+
+async def _get_com_retentativas(numero_nf: str, cnpj: str) -> httpx.Response:
+    """
+    Repete o GET em erro de conexão ou 5xx com backoff exponencial e jitter,
+    até RETRY_MAX_TENTATIVAS ou RETRY_ORCAMENTO segundos no total. O 429 não
+    entra aqui: chamar_jamef já o reenfileira respeitando o Retry-After.
+    """
+    inicio    = time.monotonic()
+    tentativa = 0
+    while True:
+        tentativa += 1
+        erro = None
+        try:
+            resp = await _get_autenticado(numero_nf, cnpj)
+            retentavel = resp.status_code >= 500
+        except RETRY_EXCECOES as e:
+            erro, retentavel = e, True
+
+        if not retentavel or tentativa >= RETRY_MAX_TENTATIVAS:
+            break
+        espera = random.uniform(0, min(RETRY_MAX_ESPERA, RETRY_BASE * 2 ** (tentativa - 1)))
+        if time.monotonic() - inicio + espera > RETRY_ORCAMENTO:
+            break
+        await asyncio.sleep(espera)
+
+    if erro is not None:
+        raise erro
+    return resp
 
-    data = resp.json()
-    rastreamentos = data.get("dado", [{}])[0].get("rastreamento", [])
+
+async def consultar_jamef(numero_nf: str, cnpj: str) -> ResultadoRastreamento:
+    resp = await _get_com_retentativas(numero_nf, cnpj)
+    resp.raise_for_status()
+    inicio = time.monotonic()
+    try:
+        return decodificar_rastreamento(resp.content, numero_nf)
+    finally:
+        registrar_tempo("parse", inicio)
+
+
+def _cidade_uf(local: Optional[_LocalJamef]) -> Optional[str]:
+    if local is None or not local.cidade:
+        return None
+    return f"{local.cidade}-{local.uf or ''}"
+
+
+def decodificar_rastreamento(corpo: bytes, numero_nf: str) -> ResultadoRastreamento:
+    """
+    Valida o payload de /consulta/v1/rastreamento uma única vez e monta o
+    ResultadoRastreamento final sem dicts intermediários nem nova validação.
+    """
+    # orjson + validação em modo Python mediu ~2x mais rápido que model_validate_json
+    return montar_resultado(_RespostaJamef.model_validate(orjson.loads(corpo)), numero_nf)
+
+
+def montar_resultado(data: _RespostaJamef, numero_nf: str) -> ResultadoRastreamento:
+    """Monta o ResultadoRastreamento a partir do payload já validado, sem revalidar."""
+    rastreamentos = data.dado[0].rastreamento if data.dado else []
 
     if not rastreamentos:
         raise ValueError(f"Nenhum rastreamento encontrado para NF {numero_nf}")
 
-    r      = rastreamentos[0]
-    rem    = r.get("remetente",   {})
-    dest   = r.get("destinatario", {})
-    frete  = r.get("frete",        {})
-    eventos = r.get("eventosRastreio", [])
-
-    origem  = f"{rem.get('cidade','')}-{rem.get('uf','')}"   if rem.get("cidade")  else None
-    destino = f"{dest.get('cidade','')}-{dest.get('uf','')}" if dest.get("cidade") else None
-
-    historico = [
-        {
-            "data":             ev.get("data"),
-            "status":           ev.get("status"),
-            "estado_origem":    ev.get("localOrigem",  {}).get("uf"),
-            "municipio_origem": ev.get("localOrigem",  {}).get("cidade"),
-            "estado_destino":   ev.get("localDestino", {}).get("uf"),
-            "municipio_destino":ev.get("localDestino", {}).get("cidade"),
-        }
-        for ev in eventos
-    ]
+    r = rastreamentos[0]
+    historico = r.eventosRastreio
+    return ResultadoRastreamento.model_construct(
+        nf=numero_nf,
+        origem=_cidade_uf(r.remetente),
+        destino=_cidade_uf(r.destinatario),
+        previsao_entrega=r.frete.previsaoEntrega if r.frete else None,
+        status_atual=historico[0].status if historico else None,
+        historico=historico,
+    )
+
+
+async def consultar_rastreamento(numero_nf: str, cnpj: str) -> ResultadoRastreamento:
+    """
+    Consulta a NF passando pelo cache de resultados antes de ir à Jamef.
+    Resultado expirado dentro de CACHE_STALE_JANELA volta na hora (stale)
+    enquanto uma atualização roda em background.
+    """
+    chave = (cnpj, numero_nf)
+    em_cache = cache_resultados.get(chave, CACHE_STALE_JANELA)
+    if em_cache is not None:
+        resultado, fetched_at, fresco = em_cache
+        if not fresco:
+            revalidar(chave, numero_nf, cnpj)
+        registrar_consulta(tentativas=0)
+        return com_metadados(resultado, fetched_at, stale=not fresco)
+
+    try:
+        resultado, info = await asyncio.shield(_consulta_compartilhada(chave, numero_nf, cnpj))
+    except CircuitoAberto:
+        # Jamef fora do ar: melhor o último resultado conhecido do que nada
+        antigo = cache_resultados.get_stale(chave)
+        if antigo is None:
+            raise
+        registrar_consulta(tentativas=0)
+        return com_metadados(*antigo, stale=True)
+    registrar_consulta(**info)
+    return com_metadados(resultado, info["fetched_at"], stale=False)
 
-    return {
-        "nf":               numero_nf,
-        "origem":           origem,
-        "destino":          destino,
-        "previsao_entrega": frete.get("previsaoEntrega"),
-        "status_atual":     historico[0]["status"] if historico else None,
-        "historico":        historico,
-    }
 
+def _consulta_compartilhada(chave: tuple, numero_nf: str, cnpj: str) -> asyncio.Future:
+    """Chamadas simultâneas para a mesma NF aguardam uma única consulta upstream."""
+    task = _consultas_em_andamento.get(chave)
+    if task is None:
+        task = asyncio.ensure_future(_consultar_e_cachear(chave, numero_nf, cnpj))
+        _consultas_em_andamento[chave] = task
+    return task
 
-async def executar_job(job_id: str, numero_nf: str, cnpj: str):
-    """Roda a consulta em background e salva o resultado no dicionário de jobs."""
+
+def revalidar(chave: tuple, numero_nf: str, cnpj: str):
+    """Dispara a atualização em background de uma entrada stale do cache."""
+    if chave in _consultas_em_andamento:
+        return
+    task = _consulta_compartilhada(chave, numero_nf, cnpj)
+    # Ninguém aguarda esta task: consome a exceção para não poluir o log
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+def com_metadados(resultado: ResultadoRastreamento, fetched_at: float, stale: bool) -> ResultadoRastreamento:
+    """Cópia rasa do resultado com a idade (fetched_at) e se veio expirado do cache."""
+    return resultado.model_copy(update={
+        "stale":      stale,
+        "fetched_at": datetime.fromtimestamp(fetched_at, timezone.utc).isoformat(),
+    })
+
+
+async def _consultar_e_cachear(chave: tuple, numero_nf: str, cnpj: str) -> tuple[ResultadoRastreamento, dict]:
+    # A task tem cópia própria do contexto: o info é dela e volta para todos os que aguardam
+    info: dict = {}
+    _consulta_info.set(info)
     try:
         resultado = await consultar_jamef(numero_nf, cnpj)
-        jobs[job_id]["status"] = "done"
-        jobs[job_id]["result"] = resultado
+        cache_resultados.set(chave, resultado)
+        info["fetched_at"] = time.time()
+        return resultado, info
+    except Exception as e:
+        # Anexa o info à exceção para quem aguarda saber quantas tentativas houve
+        e.consulta_info = info
+        raise
+    finally:
+        _consultas_em_andamento.pop(chave, None)
+
+
+def fechar_timings(info: dict, job: Job, fila: float) -> dict:
+    """Fases do job em ms: a espera na fila e o total em volta das fases da consulta."""
+    # Cópia: o info pode ser o da task compartilhada entre vários jobs
+    timings = {"fila": fila, **info.get("timings", {})}
+    timings["total"] = (time.time() - job.created_at) * 1000
+    return {fase: round(ms, 1) for fase, ms in timings.items()}
+
+
+async def executar_job(job: Job, numero_nf: str, cnpj: str):
+    """Roda a consulta em background e salva o resultado no job store."""
+    info: dict = {}
+    _consulta_info.set(info)
+    fila = (time.time() - job.created_at) * 1000
+    try:
+        resultado = await consultar_rastreamento(numero_nf, cnpj)
+        job.tentativas = info.get("tentativas")
+        job.timings    = fechar_timings(info, job, fila)
+        corpo = serializar_status(
+            job.job_id, "done", result=resultado, tentativas=job.tentativas, timings=job.timings,
+        )
+        await jobs.finalizar(job, "done", result=resultado, corpo=corpo)
+        jobs_finalizados.inc(tipo="nf", status="done")
     except Exception as e:
-        jobs[job_id]["status"] = "error"
-        jobs[job_id]["error"]  = str(e)
+        info = getattr(e, "consulta_info", info)
+        job.tentativas = info.get("tentativas")
+        job.timings    = fechar_timings(info, job, fila)
+        corpo = serializar_status(
+            job.job_id, "error", error=str(e), tentativas=job.tentativas, timings=job.timings,
+        )
+        await jobs.finalizar(job, "error", error=str(e), corpo=corpo)
+        jobs_finalizados.inc(tipo="nf", status="error")
+    finally:
+        if jobs_em_andamento.get((cnpj, numero_nf)) == job.job_id:
+            del jobs_em_andamento[(cnpj, numero_nf)]
+        publicar(f"job:{job.job_id}", mensagem_job(job))
+        publicar(topico_nf(cnpj, numero_nf), mensagem_nf(numero_nf, cnpj, job.status, job.result, job.error))
+
+
+async def aguardar_job(job: Job, timeout: float) -> Job:
+    """
+    Espera o job sair de "processing" por até `timeout` segundos. Jobs deste
+    worker acordam pelo Event; os de outro worker são relidos do backend.
+    """
+    if jobs.local(job.job_id) is job or not jobs.compartilhado:
+        try:
+            await asyncio.wait_for(job.concluido.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job
+
+    prazo = time.monotonic() + timeout
+    while job.status == "processing" and time.monotonic() < prazo:
+        await asyncio.sleep(min(STATUS_POLL_INTERVALO, max(0.0, prazo - time.monotonic())))
+        job = await jobs.get(job.job_id) or job
+    return job
+
+
+def normalizar_lote(req: LoteRequest) -> list[tuple[str, str]]:
+    """Converte o corpo do lote em pares (numero_nf, cnpj), validando o tamanho."""
+    pares = []
+    for item in req.nfs:
+        if isinstance(item, str):
+            pares.append((item, req.cnpj))
+        else:
+            pares.append((item.numero_nf, item.cnpj or req.cnpj))
+    if not pares:
+        raise HTTPException(status_code=422, detail="Lote vazio")
+    if len(pares) > LOTE_MAX_NFS:
+        raise HTTPException(status_code=422, detail=f"Lote excede o máximo de {LOTE_MAX_NFS} NFs")
+    return pares
+
+
+async def consultar_item_lote(numero_nf: str, cnpj: str, sem: asyncio.Semaphore) -> dict:
+    """Consulta uma NF do lote e devolve o item no formato de ItemLoteStatus."""
+    item = {"nf": numero_nf, "cnpj": cnpj, "status": "done", "result": None, "error": None}
+    async with sem:
+        try:
+            item["result"] = await consultar_rastreamento(numero_nf, cnpj)
+        except Exception as e:
+            item["status"] = "error"
+            item["error"]  = str(e)
+    publicar(topico_nf(cnpj, numero_nf), mensagem_nf(numero_nf, cnpj, item["status"], item["result"], item["error"]))
+    return item
+
+
+async def executar_lote(job: Job):
+    """Consulta todas as NFs do lote com no máximo LOTE_CONCORRENCIA em paralelo."""
+    sem   = asyncio.Semaphore(LOTE_CONCORRENCIA)
+    itens = job.itens
+
+    salvo_em = [time.monotonic()]
+
+    async def consultar_item(i: int):
+        itens[i] = await consultar_item_lote(itens[i]["nf"], itens[i]["cnpj"], sem)
+        # Backends compartilhados: publica o progresso no máximo a cada LOTE_PROGRESSO_INTERVALO
+        if jobs.compartilhado and time.monotonic() - salvo_em[0] >= LOTE_PROGRESSO_INTERVALO:
+            salvo_em[0] = time.monotonic()
+            await jobs.salvar_progresso(job)
+
+    await asyncio.gather(*(consultar_item(i) for i in range(len(itens))))
+    await jobs.finalizar(job, "done")
+    jobs_finalizados.inc(tipo="lote", status="done")
+    publicar(f"job:{job.job_id}", {"tipo": "lote", "job_id": job.job_id, "status": "done"})
+
+
+async def transmitir_lote(pares: list[tuple[str, str]], formato: str):
+    """
+    Gera cada item do lote assim que sua consulta termina, sem acumular o lote
+    em memória. Se o cliente desconectar, as consultas pendentes são canceladas.
+    """
+    sem   = asyncio.Semaphore(LOTE_CONCORRENCIA)
+    tasks = [asyncio.ensure_future(consultar_item_lote(nf, cnpj, sem)) for nf, cnpj in pares]
+    try:
+        for proxima in asyncio.as_completed(tasks):
+            linha = orjson.dumps(await proxima, default=para_json)
+            yield b"data: " + linha + b"\n\n" if formato == "sse" else linha + b"\n"
+        if formato == "sse":
+            yield b"event: fim\ndata: {}\n\n"
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def para_json(obj):
+    """`default` do orjson: modelos Pydantic viram dicts compatíveis com JSON."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    raise TypeError
+
+
+def responder(modelo: BaseModel) -> Response:
+    """
+    Serializa um modelo já validado direto em bytes. Devolver um Response faz o
+    FastAPI pular a revalidação do response_model, que percorreria de novo o
+    histórico inteiro; resultados já validados na decodificação não são revistos.
+    """
+    # model_dump + orjson mediu mais rápido que model_dump_json para históricos longos
+    return Response(orjson.dumps(modelo.model_dump()), media_type="application/json")
+
+
+def serializar_status(
+    job_id: str,
+    status: str,
+    result: Optional[ResultadoRastreamento] = None,
+    error: Optional[str] = None,
+    tentativas: Optional[int] = None,
+    timings: Optional[dict] = None,
+) -> bytes:
+    """Corpo final de /status/{job_id}, gerado uma vez quando o job termina."""
+    return orjson.dumps(JobStatus(
+        job_id=job_id, status=status, result=result, error=error, tentativas=tentativas, timings=timings,
+    ).model_dump())
+
+
+# ── Fila de jobs ──────────────────────────────────────────────────────────────
+
+class FilaCheia(Exception):
+    """A fila de jobs atingiu FILA_MAX; o cliente deve tentar mais tarde."""
+
+
+class FilaJobs:
+    """
+    Fila limitada consumida por um número fixo de workers: limita as consultas
+    simultâneas de /rastrear e, cheia, recusa em vez de acumular tasks.
+    """
+
+    def __init__(self, workers: int, max_itens: int):
+        self.workers    = workers
+        self.fila: asyncio.Queue = asyncio.Queue(maxsize=max_itens)
+        self.ocupados   = 0
+        self.atendidos  = 0
+        self.recusados  = 0
+        self.espera_total = 0.0
+        self.espera_max   = 0.0
+
+    def iniciar(self) -> list[asyncio.Task]:
+        return [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def cheia(self) -> bool:
+        return self.fila.full()
+
+    def enfileirar(self, job: Job, numero_nf: str, cnpj: str):
+        try:
+            self.fila.put_nowait((time.monotonic(), job, numero_nf, cnpj))
+        except asyncio.QueueFull:
+            self.recusar()
+            raise FilaCheia() from None
+
+    def recusar(self):
+        self.recusados += 1
+        fila_recusados.inc()
+
+    async def _worker(self):
+        while True:
+            enfileirado_em, job, numero_nf, cnpj = await self.fila.get()
+            espera = time.monotonic() - enfileirado_em
+            self.atendidos    += 1
+            self.espera_total += espera
+            self.espera_max    = max(self.espera_max, espera)
+            fila_espera.observar(espera)
+            self.ocupados += 1
+            try:
+                await executar_job(job, numero_nf, cnpj)
+            except Exception:
+                pass   # executar_job já grava o erro no job; o worker não pode morrer
+            finally:
+                self.ocupados -= 1
+                self.fila.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "workers":         self.workers,
+            "ocupados":        self.ocupados,
+            "profundidade":    self.fila.qsize(),
+            "max_itens":       self.fila.maxsize,
+            "atendidos":       self.atendidos,
+            "recusados":       self.recusados,
+            "espera_media_ms": round(self.espera_total / self.atendidos * 1000, 1) if self.atendidos else 0.0,
+            "espera_max_ms":   round(self.espera_max * 1000, 1),
+        }
+
+
+fila_jobs = FilaJobs(FILA_WORKERS, FILA_MAX)
+
+
+def fila_cheia() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Fila de consultas cheia, tente novamente em instantes",
+        headers={"Retry-After": str(FILA_RETRY_AFTER)},
+    )
 
 
 # ── Endpoints ─────────────────────────────────────────────────────────────────
@@ -166,50 +1325,277 @@ def root():
     return {"status": "ok", "message": "Jamef Rastreamento API rodando"}
 
 
-@app.get("/rastrear/{numero_nf}", response_model=JobIniciado)
+@app.get("/rastrear/{numero_nf}", response_model=ResultadoRastreamento | JobIniciado)
 async def rastrear(
     numero_nf: str,
-    background_tasks: BackgroundTasks,
     cnpj: str = CNPJ_PADRAO,
+    sync: bool = False,
+    timeout: float = SYNC_TIMEOUT_PADRAO,
 ):
     """
-    Inicia a consulta de uma NF em background.
+    Enfileira a consulta de uma NF para os workers da fila de jobs.
     Retorna job_id — use GET /status/{job_id} para obter o resultado.
+    Com a fila cheia (FILA_MAX) responde 503 com Retry-After.
+
+    Com ?sync=true aguarda até `timeout` segundos (máx. SYNC_MAX_TIMEOUT) e
+    devolve o ResultadoRastreamento direto; se o prazo estourar, devolve o
+    job_id normalmente e a consulta segue em background.
     """
-    limpar_jobs_antigos()
+    # Já existe consulta dessa NF rodando: reaproveita o mesmo job
+    job = jobs.local(jobs_em_andamento.get((cnpj, numero_nf)))
+    if job is None:
+        # Recusa antes de criar o job; o except abaixo cobre quem encheu a fila no meio tempo
+        if fila_jobs.cheia():
+            fila_jobs.recusar()
+            raise fila_cheia()
+        job = await jobs.criar()
+        try:
+            fila_jobs.enfileirar(job, numero_nf, cnpj)
+        except FilaCheia:
+            await jobs.finalizar(job, "error", error="Fila de consultas cheia")
+            raise fila_cheia()
+        jobs_em_andamento[(cnpj, numero_nf)] = job.job_id
+    job_id = job.job_id
+
+    if sync:
+        try:
+            await asyncio.wait_for(job.concluido.wait(), timeout=min(timeout, SYNC_MAX_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+        if job.status == "done":
+            resposta = responder(ResultadoRastreamento.model_validate(job.result))
+            resposta.headers.update(server_timing(job.timings))
+            return resposta
+        if job.status == "error":
+            raise HTTPException(status_code=502, detail=job.error, headers=server_timing(job.timings))
 
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {
-        "status":     "processing",
-        "result":     None,
-        "error":      None,
-        "created_at": time.time(),
+    return {
+        "job_id":  job_id,
+        "status":  "processing",
+        "message": f"Consulta da NF {numero_nf} iniciada. Verifique o resultado em /status/{job_id}",
     }
 
-    background_tasks.add_task(executar_job, job_id, numero_nf, cnpj)
+
+@app.post("/rastrear/lote", response_model=JobIniciado)
+async def rastrear_lote(req: LoteRequest, background_tasks: BackgroundTasks):
+    """
+    Inicia a consulta de várias NFs em um único job.
+    Acompanhe o progresso e os resultados por NF em GET /lote/{job_id}.
+    """
+    pares = normalizar_lote(req)
+
+    job = await jobs.criar(itens=[
+        {"nf": nf, "cnpj": cnpj, "status": "processing", "result": None, "error": None}
+        for nf, cnpj in pares
+    ])
+    job_id = job.job_id
+
+    background_tasks.add_task(executar_lote, job)
 
     return {
         "job_id":  job_id,
         "status":  "processing",
-        "message": f"Consulta da NF {numero_nf} iniciada. Verifique o resultado em /status/{job_id}",
+        "message": f"Consulta de {len(pares)} NFs iniciada. Verifique o progresso em /lote/{job_id}",
     }
 
 
+@app.post("/rastrear/lote/stream")
+async def rastrear_lote_stream(req: LoteRequest, formato: str = "ndjson"):
+    """
+    Consulta várias NFs e transmite cada resultado (ou erro) assim que fica pronto.
+    - formato=ndjson → um JSON por linha (application/x-ndjson)
+    - formato=sse    → Server-Sent Events, encerrado pelo evento "fim"
+    """
+    if formato not in ("ndjson", "sse"):
+        raise HTTPException(status_code=422, detail="formato deve ser 'ndjson' ou 'sse'")
+
+    pares = normalizar_lote(req)
+
+    media_type = "text/event-stream" if formato == "sse" else "application/x-ndjson"
+    return StreamingResponse(transmitir_lote(pares, formato), media_type=media_type)
+
+
+@app.get("/lote/{job_id}", response_model=LoteStatus)
+async def lote_status(job_id: str):
+    """Retorna o progresso de um lote e o resultado (ou erro) de cada NF."""
+    job = await jobs.get(job_id)
+    if job is None or job.itens is None:
+        raise HTTPException(status_code=404, detail="Lote não encontrado ou expirado")
+
+    itens = job.itens
+    return responder(LoteStatus(
+        job_id=job_id,
+        status=job.status,
+        total=len(itens),
+        concluidos=sum(1 for i in itens if i["status"] != "processing"),
+        erros=sum(1 for i in itens if i["status"] == "error"),
+        itens=itens,
+    ))
+
+
 @app.get("/status/{job_id}", response_model=JobStatus)
-def status(job_id: str):
+async def status(job_id: str, wait: float = 0):
     """
     Retorna o status de um job de rastreamento.
-    - processing → ainda executando (faça polling a cada 3s)
+    - processing → ainda executando
     - done        → resultado disponível em .result
     - error       → erro disponível em .error
+
+    Com ?wait=<segundos> (máx. STATUS_MAX_WAIT) a requisição fica aberta até o
+    job sair de "processing" ou o tempo acabar, dispensando o polling a cada 3s.
+
+    Jobs finalizados guardam a resposta serializada (nos backends compartilhados,
+    gravada junto do registro); o polling repetido só devolve os mesmos bytes,
+    sem decodificar, validar nem serializar de novo.
     """
-    if job_id not in jobs:
+    job = await jobs.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job não encontrado ou expirado")
+    if job.itens is not None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} é um lote; consulte /lote/{job_id}")
+
+    if wait > 0 and job.status == "processing":
+        job = await aguardar_job(job, min(wait, STATUS_MAX_WAIT))
+    if job.corpo is not None:
+        return Response(job.corpo, media_type="application/json")
+    return responder(JobStatus(
+        job_id=job_id,
+        status=job.status,
+        result=job.result,
+        error=job.error,
+        tentativas=job.tentativas,
+        timings=job.timings,
+    ))
+
+
+@app.websocket("/ws")
+async def ws_status(websocket: WebSocket):
+    """
+    Multiplexa atualizações de vários jobs e NFs em uma única conexão.
+    O cliente envia mensagens JSON:
+      {"acao": "assinar",  "jobs": ["<job_id>", ...], "nfs": [{"numero_nf": "123", "cnpj": "..."}]}
+      {"acao": "cancelar", "jobs": [...], "nfs": [...]}
+    e recebe {"tipo": "job", ...} ou {"tipo": "nf", ...} assim que cada consulta termina.
+    Jobs já finalizados no momento da assinatura são enviados imediatamente.
+    Jobs em andamento em outro worker (backends compartilhados) não passam por
+    publicar() deste processo: uma task por assinatura relê o backend até o fim.
+    """
+    await websocket.accept()
+    fila: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_PENDENTES)
+    topicos: set = set()
+    observadores: dict = {}   # job_id -> task que acompanha um job de outro worker
+
+    async def observar(job: Job):
+        try:
+            while True:
+                try:
+                    job = await aguardar_job(job, STATUS_MAX_WAIT)
+                    if job.status != "processing":
+                        await fila.put(mensagem_job(job))
+                        return
+                    if await jobs.get(job.job_id) is None:
+                        await fila.put({"tipo": "job", "job_id": job.job_id, "status": "not_found"})
+                        return
+                except Exception:
+                    await asyncio.sleep(STATUS_POLL_INTERVALO)   # backend indisponível: tenta de novo
+        finally:
+            if observadores.get(job.job_id) is asyncio.current_task():
+                del observadores[job.job_id]
+
+    async def receber():
+        while True:
+            quadro = await websocket.receive()
+            if quadro["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(quadro.get("code", 1000))
+            try:
+                # Frames de texto ou binários: ambos são interpretados como JSON
+                acao, job_ids, novos = ler_mensagem_ws(quadro.get("text") or quadro.get("bytes") or b"")
+            except ValueError as e:
+                # Mensagem inválida não derruba a conexão; a resposta segue pela fila
+                await fila.put({"tipo": "erro", "error": str(e)})
+                continue
+            if acao == "assinar":
+                for t in novos:
+                    assinar(t, fila)
+                    topicos.add(t)
+                for jid in job_ids:
+                    job = await jobs.get(jid)
+                    # put com espera: muitos jobs já finalizados aguardam o enviar() drenar a fila
+                    if job is None:
+                        await fila.put({"tipo": "job", "job_id": jid, "status": "not_found"})
+                    elif job.itens is not None:
+                        continue
+                    elif job.status != "processing":
+                        await fila.put(mensagem_job(job))
+                    elif jobs.compartilhado and jobs.local(jid) is None and jid not in observadores:
+                        observadores[jid] = asyncio.create_task(observar(job))
+            else:
+                for t in novos:
+                    cancelar_assinatura(t, fila)
+                    topicos.discard(t)
+                for jid in job_ids:
+                    tarefa = observadores.pop(jid, None)
+                    if tarefa is not None:
+                        tarefa.cancel()
+
+    async def enviar():
+        while True:
+            await websocket.send_text(orjson.dumps(await fila.get(), default=para_json).decode())
+
+    tarefas = [asyncio.ensure_future(receber()), asyncio.ensure_future(enviar())]
+    try:
+        concluidas, _ = await asyncio.wait(tarefas, return_when=asyncio.FIRST_COMPLETED)
+        for t in concluidas:
+            erro = t.exception()
+            if erro is not None and not isinstance(erro, WebSocketDisconnect):
+                raise erro
+    finally:
+        for t in tarefas:
+            t.cancel()
+        for t in list(observadores.values()):
+            t.cancel()
+        for t in topicos:
+            cancelar_assinatura(t, fila)
+
+
+@app.get("/jobs")
+async def jobs_stats():
+    """Tamanho atual do job store e memória estimada, para dimensionar a instância."""
+    return await jobs.stats()
 
-    j = jobs[job_id]
+
+@app.get("/upstream")
+def upstream_stats():
+    """Estado do circuit breaker e do limitador de taxa das chamadas à Jamef."""
     return {
-        "job_id": job_id,
-        "status": j["status"],
-        "result": j["result"],
-        "error":  j["error"],
+        "circuito": circuito.stats(),
+        "limitador": {
+            "taxa":       limitador.taxa,
+            "rajada":     limitador.rajada,
+            "esperas":    limitador.esperas,
+            "pausas_429": limitador.pausas_429,
+        },
     }
+
+
+@app.get("/fila")
+def fila_stats():
+    """Profundidade da fila de jobs, workers ocupados e tempo de espera até começar."""
+    return fila_jobs.stats()
+
+
+@app.get("/cache")
+def cache_stats():
+    """Contadores do cache de resultados (hits/misses) para ajuste de TTL e tamanho."""
+    return cache_resultados.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Métricas no formato de texto do Prometheus (latências, cache, token e jobs)."""
+    stats = await jobs.stats()
+    jobs_entradas.set(stats["entradas"])
+    jobs_processing.set(stats.get("processing", len(jobs.locais)))
+    if "bytes" in stats:
+        jobs_bytes.set(stats["bytes"])
+    return Response(metricas.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,203 @@
+"""
+Teste de carga do api.py contra o servidor falso da Jamef (fake_jamef.py).
+
+Cada consulta faz GET /rastrear/{nf} e acompanha o job por GET /status/{job_id}
+(long-poll com ?wait=), ou usa ?sync=true com --sync. Ao final mede req/s,
+latência p50/p95/p99 por consulta e quantas chamadas chegaram à Jamef falsa,
+e emite tudo em JSON para comparar execuções.
+
+Com --subir o script sobe os dois servidores (fake_jamef + uvicorn api:app)
+em subprocessos e os derruba ao final; sem ele, usa os que já estão no ar.
+As variáveis de ambiente do api.py (ex.: JAMEF_RPS, que limita as chamadas à
+Jamef e costuma ser o teto do req/s sem cache) são repassadas ao subprocesso.
+
+Uso:
+    python benchmarks/bench_carga.py --subir --consultas 2000 --concorrencia 50 --nfs 200
+    python benchmarks/bench_carga.py --api http://127.0.0.1:8000 --fake http://127.0.0.1:9000 --sync
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import httpx
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def percentil(ordenados: list, p: float) -> float:
+    if not ordenados:
+        return 0.0
+    i = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[i]
+
+
+@contextmanager
+def subir_servidores(args):
+    """Sobe fake_jamef e api.py apontando um para o outro; encerra ao sair."""
+    porta_fake = args.fake.rsplit(":", 1)[1]
+    porta_api  = args.api.rsplit(":", 1)[1]
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(RAIZ, "benchmarks", "fake_jamef.py"),
+        "--porta", porta_fake, "--latencia", str(args.latencia), "--jitter", str(args.jitter),
+        "--eventos", str(args.eventos), "--taxa-erro", str(args.taxa_erro), "--taxa-429", str(args.taxa_429),
+    ])
+    env = dict(
+        os.environ,
+        JAMEF_AUTH_URL=f"{args.fake}/auth/v1/login",
+        JAMEF_RASTR_URL=f"{args.fake}/consulta/v1/rastreamento",
+        TOKEN_CACHE_PATH="",
+    )
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", porta_api, "--log-level", "warning",
+         "--workers", str(args.workers)],
+        cwd=RAIZ, env=env,
+    )
+    try:
+        yield
+    finally:
+        for p in (api, fake):
+            p.terminate()
+        for p in (api, fake):
+            p.wait(timeout=10)
+
+
+async def aguardar_no_ar(cliente: httpx.AsyncClient, url: str, prazo: float = 20.0):
+    fim = time.monotonic() + prazo
+    while True:
+        try:
+            await cliente.get(url)
+            return
+        except httpx.TransportError:
+            if time.monotonic() > fim:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def consultar(cliente: httpx.AsyncClient, api: str, nf: str, sync: bool, wait: float) -> str:
+    """Uma consulta completa; devolve o desfecho ("done", "error" ou "http_<status>")."""
+    if sync:
+        r = await cliente.get(f"{api}/rastrear/{nf}", params={"sync": "true"})
+        if r.status_code == 502:
+            return "error"
+        if r.status_code != 200:
+            return f"http_{r.status_code}"
+        corpo = r.json()
+        if "job_id" not in corpo:
+            return "done"
+        job_id = corpo["job_id"]
+    else:
+        r = await cliente.get(f"{api}/rastrear/{nf}")
+        if r.status_code != 200:
+            return f"http_{r.status_code}"
+        job_id = r.json()["job_id"]
+
+    while True:
+        r = await cliente.get(f"{api}/status/{job_id}", params={"wait": wait})
+        if r.status_code != 200:
+            return f"http_{r.status_code}"
+        status = r.json()["status"]
+        if status != "processing":
+            return status
+
+
+async def gerar_carga(args) -> dict:
+    limites = httpx.Limits(max_connections=args.concorrencia, max_keepalive_connections=args.concorrencia)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limites) as cliente:
+        await aguardar_no_ar(cliente, f"{args.api}/")
+        await aguardar_no_ar(cliente, f"{args.fake}/_stats")
+        if not args.subir:
+            # Servidores já no ar: conta só as chamadas desta execução
+            # (com --subir o login feito na inicialização do api.py entra na conta)
+            await cliente.post(f"{args.fake}/_stats/zerar")
+
+        fila: asyncio.Queue = asyncio.Queue()
+        for i in range(args.consultas):
+            fila.put_nowait(str(100000 + i % args.nfs))
+        latencias: list[float] = []
+        desfechos: dict = {}
+
+        async def trabalhador():
+            while not fila.empty():
+                nf = fila.get_nowait()
+                inicio = time.perf_counter()
+                try:
+                    desfecho = await consultar(cliente, args.api, nf, args.sync, args.wait)
+                except httpx.HTTPError as e:
+                    desfecho = type(e).__name__
+                latencias.append((time.perf_counter() - inicio) * 1000)
+                desfechos[desfecho] = desfechos.get(desfecho, 0) + 1
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(trabalhador() for _ in range(args.concorrencia)))
+        duracao = time.perf_counter() - inicio
+
+        upstream = (await cliente.get(f"{args.fake}/_stats")).json()
+
+    latencias.sort()
+    return {
+        "config": {
+            "consultas":    args.consultas,
+            "concorrencia": args.concorrencia,
+            "nfs":          args.nfs,
+            "modo":         "sync" if args.sync else "async",
+            "latencia_ms":  args.latencia,
+            "eventos":      args.eventos,
+            "taxa_erro":    args.taxa_erro,
+            "taxa_429":     args.taxa_429,
+            "workers":      args.workers,
+        },
+        "duracao_s": round(duracao, 3),
+        "req_s":     round(len(latencias) / duracao, 1) if duracao else None,
+        "latencia_ms": {
+            "p50": round(percentil(latencias, 50), 1),
+            "p95": round(percentil(latencias, 95), 1),
+            "p99": round(percentil(latencias, 99), 1),
+            "max": round(latencias[-1], 1) if latencias else 0.0,
+        },
+        "desfechos": desfechos,
+        "upstream":  upstream,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--api", default="http://127.0.0.1:8000")
+    parser.add_argument("--fake", default="http://127.0.0.1:9000")
+    parser.add_argument("--consultas", type=int, default=1000)
+    parser.add_argument("--concorrencia", type=int, default=50)
+    parser.add_argument("--nfs", type=int, default=100, help="NFs distintas (menos NFs = mais acertos no cache)")
+    parser.add_argument("--sync", action="store_true", help="usa ?sync=true em vez de /status")
+    parser.add_argument("--wait", type=float, default=10.0, help="?wait= do long-poll em /status")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout HTTP do gerador")
+    parser.add_argument("--subir", action="store_true", help="sobe fake_jamef e api.py localmente")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="workers uvicorn do api.py (com --subir; >1 requer JOBS_BACKEND=sqlite)")
+    # Repassados ao fake_jamef quando --subir
+    parser.add_argument("--latencia", type=float, default=50.0)
+    parser.add_argument("--jitter", type=float, default=20.0)
+    parser.add_argument("--eventos", type=int, default=20)
+    parser.add_argument("--taxa-erro", type=float, default=0.0)
+    parser.add_argument("--taxa-429", type=float, default=0.0)
+    parser.add_argument("--saida", help="grava o JSON também neste arquivo")
+    args = parser.parse_args()
+
+    if args.subir:
+        with subir_servidores(args):
+            resultado = asyncio.run(gerar_carga(args))
+    else:
+        resultado = asyncio.run(gerar_carga(args))
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Compara o custo de CPU por requisição dos caminhos JSON em históricos grandes:
+stdlib (json + JSONResponse), orjson (orjson + ORJSONResponse, ainda com o
+dict intermediário) e tipado (decodificar_rastreamento + responder).
+
+Cada iteração faz o que uma consulta faz: decodifica o payload da Jamef,
+normaliza, valida em JobStatus e serializa a resposta de /status.
+
+Uso:
+    python benchmarks/bench_json.py
+    python benchmarks/bench_json.py --eventos 10 100 1000 5000 --repeticoes 200 --json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import orjson
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from api import JobStatus, decodificar_rastreamento, responder
+from payloads import gerar_payload
+
+
+def normalizar_rastreamento(data: dict, numero_nf: str) -> dict:
+    """Normalização antiga via dict, mantida aqui só como base de comparação."""
+    r       = data["dado"][0]["rastreamento"][0]
+    rem     = r.get("remetente",    {})
+    dest    = r.get("destinatario", {})
+    historico = [
+        {
+            "data":             ev.get("data"),
+            "status":           ev.get("status"),
+            "estado_origem":    ev.get("localOrigem",  {}).get("uf"),
+            "municipio_origem": ev.get("localOrigem",  {}).get("cidade"),
+            "estado_destino":   ev.get("localDestino", {}).get("uf"),
+            "municipio_destino":ev.get("localDestino", {}).get("cidade"),
+        }
+        for ev in r.get("eventosRastreio", [])
+    ]
+    return {
+        "nf":               numero_nf,
+        "origem":           f"{rem.get('cidade','')}-{rem.get('uf','')}"   if rem.get("cidade")  else None,
+        "destino":          f"{dest.get('cidade','')}-{dest.get('uf','')}" if dest.get("cidade") else None,
+        "previsao_entrega": r.get("frete", {}).get("previsaoEntrega"),
+        "status_atual":     historico[0]["status"] if historico else None,
+        "historico":        historico,
+    }
+
+
+# Mesmo trabalho que o FastAPI faz com response_model: valida e gera o dict
+# compatível com JSON (model_dump mode="json"); só o render muda de classe
+def caminho_stdlib(corpo: bytes) -> bytes:
+    resultado = normalizar_rastreamento(json.loads(corpo), "123")
+    status = JobStatus.model_validate({"job_id": "x", "status": "done", "result": resultado})
+    return JSONResponse(status.model_dump(mode="json")).body
+
+
+def caminho_orjson(corpo: bytes) -> bytes:
+    resultado = normalizar_rastreamento(orjson.loads(corpo), "123")
+    status = JobStatus.model_validate({"job_id": "x", "status": "done", "result": resultado})
+    return ORJSONResponse(status.model_dump(mode="json")).body
+
+
+# Caminho atual: uma passada validando os bytes direto nos modelos e
+# serialização via responder(), sem a revalidação do response_model
+def caminho_tipado(corpo: bytes) -> bytes:
+    resultado = decodificar_rastreamento(corpo, "123")
+    return responder(JobStatus(job_id="x", status="done", result=resultado)).body
+
+
+def medir(func, arg, repeticoes: int, rodadas: int) -> float:
+    """Tempo de CPU por chamada em microssegundos (melhor rodada, menos ruído de GC/agendador)."""
+    func(arg)   # aquecimento
+    melhor = float("inf")
+    for _ in range(rodadas):
+        inicio = time.process_time()
+        for _ in range(repeticoes):
+            func(arg)
+        melhor = min(melhor, (time.process_time() - inicio) / repeticoes)
+    return melhor * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--eventos", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--repeticoes", type=int, default=50)
+    parser.add_argument("--rodadas", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="emite os resultados em JSON")
+    args = parser.parse_args()
+
+    linhas = []
+    for n in args.eventos:
+        corpo   = orjson.dumps(gerar_payload(n))
+        status = JobStatus(job_id="x", status="done", result=decodificar_rastreamento(corpo, "123"))
+        estagios = {
+            "decode": (json.loads, orjson.loads, lambda c: decodificar_rastreamento(c, "123"), corpo),
+            "encode": (lambda s: JSONResponse(s.model_dump(mode="json")).body,
+                       lambda s: ORJSONResponse(s.model_dump(mode="json")).body,
+                       lambda s: responder(s).body, status),
+            "total":  (caminho_stdlib, caminho_orjson, caminho_tipado, corpo),
+        }
+        for estagio, (stdlib_f, orjson_f, tipado_f, arg) in estagios.items():
+            stdlib = medir(stdlib_f, arg, args.repeticoes, args.rodadas)
+            tipado = medir(tipado_f, arg, args.repeticoes, args.rodadas)
+            linhas.append({
+                "eventos":   n,
+                "bytes":     len(corpo),
+                "estagio":   estagio,
+                "stdlib_us": round(stdlib, 1),
+                "orjson_us": round(medir(orjson_f, arg, args.repeticoes, args.rodadas), 1),
+                "tipado_us": round(tipado, 1),
+                "speedup":   round(stdlib / tipado, 2) if tipado else None,
+            })
+
+    if args.json:
+        print(json.dumps(linhas, indent=2))
+        return
+    print(f"{'eventos':>8} {'bytes':>10} {'estagio':>8} {'stdlib µs':>12} {'orjson µs':>12} "
+          f"{'tipado µs':>12} {'speedup':>8}")
+    for l in linhas:
+        print(f"{l['eventos']:>8} {l['bytes']:>10} {l['estagio']:>8} "
+              f"{l['stdlib_us']:>12} {l['orjson_us']:>12} {l['tipado_us']:>12} {l['speedup']:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Microbenchmark do caminho quente de uma consulta, estágio por estágio, em
+históricos de 10 a 10.000 eventos.
+
+Estágios (os mesmos de decodificar_rastreamento + serializar_status):
+- decode:       orjson.loads dos bytes da Jamef
+- validacao:    _RespostaJamef.model_validate (inclui os eventos do histórico)
+- normalizacao: montar_resultado (ResultadoRastreamento sem revalidar)
+- serializacao: serializar_status (corpo final de /status)
+- total:        bytes da Jamef -> bytes de /status
+
+Tempo: melhor de --rodadas, com o número de chamadas por rodada escolhido pelo
+timeit.autorange. Alocações: tracemalloc numa chamada isolada, com o pico de
+memória do estágio e quantos blocos continuam vivos no que ele devolve.
+
+Uso:
+    python benchmarks/bench_normalizacao.py
+    python benchmarks/bench_normalizacao.py --eventos 10 100 1000 10000 --json
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import orjson
+
+from api import _RespostaJamef, montar_resultado, decodificar_rastreamento, serializar_status
+from payloads import gerar_payload
+
+
+def estagios(corpo: bytes) -> dict:
+    """Função de cada estágio, já com a entrada produzida pelo estágio anterior."""
+    dados     = orjson.loads(corpo)
+    validado  = _RespostaJamef.model_validate(dados)
+    resultado = montar_resultado(validado, "123")
+    return {
+        "decode":       lambda: orjson.loads(corpo),
+        "validacao":    lambda: _RespostaJamef.model_validate(dados),
+        "normalizacao": lambda: montar_resultado(validado, "123"),
+        "serializacao": lambda: serializar_status("x", "done", result=resultado, tentativas=1),
+        "total":        lambda: serializar_status("x", "done", result=decodificar_rastreamento(corpo, "123")),
+    }
+
+
+def medir_tempo(func, rodadas: int) -> float:
+    """Microssegundos por chamada na melhor rodada."""
+    timer = timeit.Timer(func)
+    numero, _ = timer.autorange()
+    return min(timer.repeat(repeat=rodadas, number=numero)) / numero * 1e6
+
+
+def medir_alocacoes(func) -> tuple[int, int]:
+    """(pico de bytes, blocos vivos no retorno) de uma chamada, descontando o que já existia."""
+    func()   # aquecimento: caches internos do Pydantic não contam para o estágio
+    tracemalloc.start()
+    try:
+        antes = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        retorno = func()
+        _, pico = tracemalloc.get_traced_memory()
+        depois  = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del retorno
+    blocos = sum(max(0, d.count_diff) for d in depois.compare_to(antes, "filename"))
+    return pico - base, blocos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--eventos", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--rodadas", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="emite os resultados em JSON")
+    args = parser.parse_args()
+
+    linhas = []
+    for n in args.eventos:
+        corpo = orjson.dumps(gerar_payload(n))
+        for estagio, func in estagios(corpo).items():
+            pico, blocos = medir_alocacoes(func)
+            us = medir_tempo(func, args.rodadas)
+            linhas.append({
+                "eventos":       n,
+                "bytes":         len(corpo),
+                "estagio":       estagio,
+                "us":            round(us, 1),
+                "us_por_evento": round(us / n, 3),
+                "pico_bytes":    pico,
+                "blocos":        blocos,
+            })
+
+    if args.json:
+        print(json.dumps(linhas, indent=2))
+        return
+    print(f"{'eventos':>8} {'estagio':>13} {'µs':>12} {'µs/evento':>10} {'pico KiB':>10} {'blocos':>9}")
+    for l in linhas:
+        print(f"{l['eventos']:>8} {l['estagio']:>13} {l['us']:>12} {l['us_por_evento']:>10} "
+              f"{l['pico_bytes'] / 1024:>10.1f} {l['blocos']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Servidor local que imita a API Jamef para testes de carga do api.py.
+
+Implementa /auth/v1/login e /consulta/v1/rastreamento com o mesmo formato de
+resposta da Jamef, mais latência, taxa de erros e tamanho de histórico
+configuráveis. GET /_stats devolve quantas chamadas cada rota recebeu.
+
+Uso:
+    python benchmarks/fake_jamef.py --porta 9000 --latencia 80 --jitter 40 --eventos 50 --taxa-erro 0.02
+
+e aponte o api.py para ele:
+    JAMEF_AUTH_URL=http://127.0.0.1:9000/auth/v1/login \\
+    JAMEF_RASTR_URL=http://127.0.0.1:9000/consulta/v1/rastreamento uvicorn api:app
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from payloads import gerar_payload
+
+# Variações de payload pré-serializadas; a NF escolhe uma pelo hash
+VARIANTES = 16
+
+
+def criar_app(latencia: float, jitter: float, eventos: int, taxa_erro: float, taxa_429: float,
+              expires_in: int, seed: int = 0) -> FastAPI:
+    """App com o comportamento configurado; latências em milissegundos."""
+    app   = FastAPI()
+    rng   = random.Random(seed)
+    stats = {"auth": 0, "rastreamento": 0, "erros_5xx": 0, "respostas_429": 0, "nao_encontradas": 0}
+    payloads = [
+        orjson.dumps(gerar_payload(eventos, entregue=i % 4 == 0, seed=seed + i)) for i in range(VARIANTES)
+    ]
+    vazio = orjson.dumps({"dado": [{"rastreamento": []}]})
+
+    async def atrasar():
+        espera = max(0.0, latencia + rng.uniform(-jitter, jitter)) / 1000
+        if espera:
+            await asyncio.sleep(espera)
+
+    def resposta_json(corpo: bytes, status: int = 200, headers: dict = None) -> Response:
+        return Response(corpo, status_code=status, media_type="application/json", headers=headers)
+
+    @app.post("/auth/v1/login")
+    async def login():
+        stats["auth"] += 1
+        await atrasar()
+        token = f"fake-{stats['auth']}"
+        return resposta_json(orjson.dumps({"dado": [{"accessToken": token, "expiresIn": expires_in}]}))
+
+    @app.get("/consulta/v1/rastreamento")
+    async def rastreamento(request: Request, numeroNotaFiscal: str = "", documentoRemetente: str = ""):
+        stats["rastreamento"] += 1
+        await atrasar()
+        if not request.headers.get("Authorization", "").startswith("Bearer fake-"):
+            return resposta_json(b'{"erro": "token invalido"}', 401)
+        sorteio = rng.random()
+        if sorteio < taxa_429:
+            stats["respostas_429"] += 1
+            return resposta_json(b'{"erro": "limite de requisicoes"}', 429, {"Retry-After": "1"})
+        if sorteio < taxa_429 + taxa_erro:
+            stats["erros_5xx"] += 1
+            return resposta_json(b'{"erro": "falha interna"}', 503)
+        if numeroNotaFiscal.startswith("0"):
+            # NFs iniciadas em 0 simulam nota inexistente
+            stats["nao_encontradas"] += 1
+            return resposta_json(vazio)
+        return resposta_json(payloads[zlib.crc32(numeroNotaFiscal.encode()) % VARIANTES])
+
+    @app.get("/_stats")
+    async def ver_stats():
+        return stats
+
+    @app.post("/_stats/zerar")
+    async def zerar_stats():
+        for chave in stats:
+            stats[chave] = 0
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=9000)
+    parser.add_argument("--latencia", type=float, default=50.0, help="latência média em ms")
+    parser.add_argument("--jitter", type=float, default=20.0, help="variação uniforme ± em ms")
+    parser.add_argument("--eventos", type=int, default=20, help="eventos no histórico de cada NF")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="fração de respostas 503")
+    parser.add_argument("--taxa-429", type=float, default=0.0, help="fração de respostas 429")
+    parser.add_argument("--expires-in", type=int, default=3600, help="validade do token em segundos")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = criar_app(args.latencia, args.jitter, args.eventos, args.taxa_erro, args.taxa_429,
+                    args.expires_in, args.seed)
+    uvicorn.run(app, host=args.host, port=args.porta, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
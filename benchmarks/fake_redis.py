@@ -0,0 +1,206 @@
+"""
+Servidor mínimo que fala o protocolo Redis (RESP2 e, após HELLO 3, RESP3),
+para exercitar o RedisJobStore sem instalar um Redis de verdade.
+
+Implementa só os comandos que o jobstore.py usa, com a mesma semântica:
+PING, SET (com EX), GET, DEL, ZADD, ZCARD, ZREMRANGEBYSCORE e ZPOPMIN, além
+de HELLO e CLIENT/SELECT (o redis-py os envia ao conectar; as versões
+recentes negociam RESP3).
+A expiração por EX é verificada na leitura, como o Redis faz no acesso.
+
+Uso:
+    python benchmarks/fake_redis.py --porta 6390
+    JOBS_BACKEND=redis JOBS_REDIS_URL=redis://127.0.0.1:6390/0 uvicorn api:app --workers 4
+
+Um servidor real (redis-server, valkey-server) também serve: o
+verificar_jobstore.py aceita --redis-url apontando para ele.
+"""
+import argparse
+import asyncio
+import time
+
+
+class ErroComando(Exception):
+    pass
+
+
+class FakeRedis:
+    """Estado do servidor: strings com expiração e sorted sets."""
+
+    def __init__(self):
+        self.strings: dict = {}   # chave -> (valor, expira_em ou None)
+        self.zsets: dict   = {}   # chave -> {membro: score}
+
+    def _viva(self, chave: bytes) -> bool:
+        item = self.strings.get(chave)
+        if item is None:
+            return False
+        if item[1] is not None and time.time() >= item[1]:
+            del self.strings[chave]
+            return False
+        return True
+
+    def executar(self, args: list[bytes], conexao: dict):
+        comando = args[0].upper().decode()
+        if comando == "HELLO":
+            return self.hello(conexao, *args[1:])
+        metodo = getattr(self, f"cmd_{comando.lower()}", None)
+        if metodo is None:
+            raise ErroComando(f"unknown command '{comando}'")
+        resposta = metodo(*args[1:])
+        if comando == "ZPOPMIN" and conexao["protocolo"] == 2:
+            # RESP2 devolve a lista achatada e o score como bulk string
+            resposta = [x for membro, score in resposta for x in (membro, repr(score).encode())]
+        return resposta
+
+    def hello(self, conexao: dict, versao: bytes = b"2", *opcoes):
+        if versao not in (b"2", b"3"):
+            raise ErroComando("NOPROTO unsupported protocol version")
+        conexao["protocolo"] = int(versao)
+        return {
+            "server": "fake_redis", "version": "7.0.0", "proto": conexao["protocolo"],
+            "id": 1, "mode": "standalone", "role": "master", "modules": [],
+        }
+
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_client(self, *args):
+        return "OK"
+
+    def cmd_select(self, *args):
+        return "OK"
+
+    def cmd_set(self, chave, valor, *opcoes):
+        expira = None
+        opcoes = [o.upper() for o in opcoes]
+        if b"EX" in opcoes:
+            expira = time.time() + int(opcoes[opcoes.index(b"EX") + 1])
+        self.strings[chave] = (valor, expira)
+        self.zsets.pop(chave, None)
+        return "OK"
+
+    def cmd_get(self, chave):
+        return self.strings[chave][0] if self._viva(chave) else None
+
+    def cmd_del(self, *chaves):
+        removidas = 0
+        for chave in chaves:
+            removidas += self._viva(chave) + (self.zsets.pop(chave, None) is not None)
+            self.strings.pop(chave, None)
+        return removidas
+
+    def cmd_zadd(self, chave, *pares):
+        zset = self.zsets.setdefault(chave, {})
+        novos = 0
+        for i in range(0, len(pares), 2):
+            score, membro = float(pares[i]), pares[i + 1]
+            novos += membro not in zset
+            zset[membro] = score
+        return novos
+
+    def cmd_zcard(self, chave):
+        return len(self.zsets.get(chave, {}))
+
+    def cmd_zremrangebyscore(self, chave, minimo, maximo):
+        zset = self.zsets.get(chave, {})
+        lo, hi = float(minimo), float(maximo)   # aceita -inf/+inf
+        remover = [m for m, s in zset.items() if lo <= s <= hi]
+        for m in remover:
+            del zset[m]
+        return len(remover)
+
+    def cmd_zpopmin(self, chave, contagem=b"1"):
+        zset = self.zsets.get(chave, {})
+        menores = sorted(zset.items(), key=lambda par: (par[1], par[0]))[:int(contagem)]
+        for membro, _ in menores:
+            del zset[membro]
+        return [[membro, score] for membro, score in menores]
+
+
+def codificar(valor, protocolo: int = 2) -> bytes:
+    """
+    Resposta em RESP: str = simple string, bytes = bulk, int, float (double no
+    RESP3), list, dict (map no RESP3, lista chave/valor no RESP2), None, erro.
+    """
+    if isinstance(valor, ErroComando):
+        texto = str(valor)
+        return f"-{texto if texto.split()[0].isupper() else 'ERR ' + texto}\r\n".encode()
+    if valor is None:
+        return b"_\r\n" if protocolo == 3 else b"$-1\r\n"
+    if isinstance(valor, bool):
+        valor = int(valor)
+    if isinstance(valor, int):
+        return f":{valor}\r\n".encode()
+    if isinstance(valor, float):
+        return f",{valor!r}\r\n".encode() if protocolo == 3 else codificar(repr(valor).encode())
+    if isinstance(valor, str):
+        return f"+{valor}\r\n".encode()
+    if isinstance(valor, bytes):
+        return b"$%d\r\n%s\r\n" % (len(valor), valor)
+    if isinstance(valor, dict):
+        itens = [x for par in valor.items() for x in par]
+        if protocolo == 3:
+            return b"%%%d\r\n" % len(valor) + b"".join(codificar(v, protocolo) for v in itens)
+        valor = itens
+    return b"*%d\r\n" % len(valor) + b"".join(codificar(v, protocolo) for v in valor)
+
+
+async def ler_comando(reader: asyncio.StreamReader) -> list[bytes]:
+    """Lê um array de bulk strings (o formato que os clientes enviam)."""
+    linha = await reader.readuntil(b"\r\n")
+    if not linha.startswith(b"*"):
+        # Comando inline (ex.: "PING" digitado no telnet)
+        return linha.strip().split()
+    args = []
+    for _ in range(int(linha[1:-2])):
+        tamanho = int((await reader.readuntil(b"\r\n"))[1:-2])
+        args.append((await reader.readexactly(tamanho + 2))[:-2])
+    return args
+
+
+async def iniciar(host: str = "127.0.0.1", porta: int = 0) -> tuple[asyncio.AbstractServer, FakeRedis]:
+    """Sobe o servidor no event loop atual; porta 0 escolhe uma livre."""
+    estado = FakeRedis()
+
+    async def atender(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conexao = {"protocolo": 2}
+        try:
+            while True:
+                args = await ler_comando(reader)
+                if not args:
+                    continue
+                try:
+                    resposta = estado.executar(args, conexao)
+                except ErroComando as e:
+                    resposta = e
+                except (ValueError, IndexError, TypeError) as e:
+                    resposta = ErroComando(f"syntax error ({e})")
+                writer.write(codificar(resposta, conexao["protocolo"]))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Cliente desconectou, ou o loop está encerrando com a conexão aberta
+            pass
+        finally:
+            writer.close()
+
+    servidor = await asyncio.start_server(atender, host, porta)
+    return servidor, estado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=6390)
+    args = parser.parse_args()
+
+    async def rodar():
+        servidor, _ = await iniciar(args.host, args.porta)
+        async with servidor:
+            await servidor.serve_forever()
+
+    asyncio.run(rodar())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Payloads sintéticos no formato da API Jamef, usados pelos benchmarks."""
+import random
+
+UFS     = ["SP", "RJ", "MG", "PR", "SC", "RS", "BA", "GO", "PE", "CE"]
+CIDADES = ["SAO PAULO", "RIO DE JANEIRO", "BELO HORIZONTE", "CURITIBA", "JOINVILLE",
+           "PORTO ALEGRE", "SALVADOR", "GOIANIA", "RECIFE", "FORTALEZA"]
+STATUS  = ["EM TRANSITO", "CHEGADA NA FILIAL", "SAIDA DA FILIAL", "EM ROTA DE ENTREGA",
+           "AGUARDANDO AGENDAMENTO", "COLETA REALIZADA"]
+
+
+def _local(rng: random.Random) -> dict:
+    i = rng.randrange(len(UFS))
+    return {"uf": UFS[i], "cidade": CIDADES[i]}
+
+
+def gerar_eventos(n_eventos: int, entregue: bool = False, seed: int = 0) -> list:
+    """Lista de eventosRastreio, do mais recente para o mais antigo."""
+    rng = random.Random(seed)
+    eventos = []
+    for i in range(n_eventos):
+        status = "ENTREGUE" if entregue and i == 0 else rng.choice(STATUS)
+        eventos.append({
+            "data":         f"2024-{1 + i // 28 % 12:02d}-{1 + i % 28:02d}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00",
+            "status":       status,
+            "localOrigem":  _local(rng),
+            "localDestino": _local(rng),
+        })
+    return eventos
+
+
+def gerar_payload(n_eventos: int, entregue: bool = False, seed: int = 0) -> dict:
+    """Resposta completa de /consulta/v1/rastreamento com `n_eventos` eventos."""
+    return {
+        "dado": [{
+            "rastreamento": [{
+                "remetente":       {"cidade": "SAO PAULO", "uf": "SP"},
+                "destinatario":    {"cidade": "RIO DE JANEIRO", "uf": "RJ"},
+                "frete":           {"previsaoEntrega": "2024-12-20"},
+                "eventosRastreio": gerar_eventos(n_eventos, entregue, seed),
+            }],
+        }],
+    }
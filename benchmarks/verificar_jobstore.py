@@ -0,0 +1,146 @@
+"""
+Exercita os backends do jobstore.py de ponta a ponta: cria, finaliza, relê
+por uma segunda instância (como outro worker uvicorn faria), publica progresso
+de lote e aplica expiração e limite de entradas em limpar_expirados().
+
+Sem --redis-url, o backend redis roda contra o fake_redis.py, iniciado no
+próprio processo; com ele, contra um servidor real (redis-server, valkey...).
+Requer o pacote opcional `redis` (pip install -r requirements-redis.txt).
+
+Uso:
+    python benchmarks/verificar_jobstore.py
+    python benchmarks/verificar_jobstore.py --backends redis --redis-url redis://127.0.0.1:6379/15
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from jobstore import MemoriaJobStore, SQLiteJobStore, RedisJobStore
+import fake_redis
+
+TTL_CURTO = 1   # segundos; o Redis só aceita EX inteiro
+
+
+async def cenario(criar_store, compartilhado: bool):
+    """
+    Roda as verificações com stores novos vindos de `criar_store(ttl, max_entradas)`.
+    Stores com os mesmos parâmetros enxergam os mesmos jobs; parâmetros
+    diferentes usam armazenamento separado, para uma etapa não afetar a outra.
+    """
+    store = criar_store(60, 100)
+    # Backends compartilhados: a leitura vem de outra instância, sem os jobs locais
+    leitor = criar_store(60, 100) if compartilhado else store
+
+    job = await store.criar()
+    lido = await leitor.get(job.job_id)
+    assert lido is not None and lido.status == "processing", "job recém-criado não foi lido de volta"
+
+    resultado = {"nf": "123", "status_atual": "EM TRANSITO", "historico": [{"status": "EM TRANSITO"}]}
+    job.tentativas = 2
+    job.timings    = {"total": 12.5}
+    await store.finalizar(job, "done", result=resultado)
+    lido = await leitor.get(job.job_id)
+    assert lido.status == "done", f"status lido: {lido.status}"
+    assert lido.result == resultado, "resultado lido difere do gravado"
+    assert lido.tentativas == 2 and lido.timings == {"total": 12.5}
+    assert lido.concluido.is_set(), "job finalizado lido sem o Event de conclusão"
+
+    # Resposta de /status já serializada: volta como está, e o result sai dela se pedido
+    com_corpo = await store.criar()
+    corpo = json.dumps({"job_id": com_corpo.job_id, "status": "done", "result": resultado}).encode()
+    await store.finalizar(com_corpo, "done", result=resultado, corpo=corpo)
+    lido = await leitor.get(com_corpo.job_id)
+    assert lido.corpo == corpo, "corpo lido difere do gravado"
+    assert lido.result == resultado, "result não recuperado do corpo"
+
+    erro = await store.criar()
+    await store.finalizar(erro, "error", error="falhou")
+    lido = await leitor.get(erro.job_id)
+    assert (lido.status, lido.error) == ("error", "falhou")
+
+    lote = await store.criar(itens=[{"nf": "1", "status": "processing"}, {"nf": "2", "status": "processing"}])
+    lote.itens[0] = {"nf": "1", "status": "done"}
+    await store.salvar_progresso(lote)
+    lido = await leitor.get(lote.job_id)
+    assert lido.status == "processing" and lido.itens[0]["status"] == "done", "progresso do lote não publicado"
+
+    assert await leitor.get(str(uuid.uuid4())) is None, "job inexistente deveria voltar None"
+    print("    criar/finalizar/reler/corpo/progresso: ok")
+
+    # Expiração: jobs com mais de ttl segundos somem na varredura (ou sozinhos, no Redis)
+    curto = criar_store(TTL_CURTO, 100)
+    velho = await curto.criar()
+    await curto.finalizar(velho, "done", result=resultado)
+    await asyncio.sleep(TTL_CURTO + 1.1)
+    await curto.limpar_expirados()
+    assert await (criar_store(TTL_CURTO, 100) if compartilhado else curto).get(velho.job_id) is None, \
+        "job expirado ainda visível"
+    print("    expiração por ttl: ok")
+
+    # Limite de entradas: os mais antigos saem e contam como evictions
+    limitado = criar_store(60, 3)
+    for _ in range(5):
+        await limitado.finalizar(await limitado.criar(), "done", result=resultado)
+    await limitado.limpar_expirados()
+    stats = await limitado.stats()
+    assert stats["entradas"] <= 3, f"limite de entradas não aplicado: {stats}"
+    assert stats["evictions"] >= 2, f"evictions não contadas: {stats}"
+    print(f"    limite de entradas: ok {stats}")
+
+    for s in {id(x): x for x in (store, leitor, curto, limitado)}.values():
+        await s.fechar()
+
+
+async def verificar(backends: list[str], redis_url: str = None):
+    falhas = 0
+    for backend in backends:
+        print(f"{backend}:")
+        servidor = None
+        try:
+            if backend == "memoria":
+                await cenario(lambda ttl, n: MemoriaJobStore(ttl, n, 1 << 30), compartilhado=False)
+            elif backend == "sqlite":
+                with tempfile.TemporaryDirectory() as pasta:
+                    await cenario(
+                        lambda ttl, n: SQLiteJobStore(os.path.join(pasta, f"jobs-{ttl}-{n}.sqlite3"), ttl, n, 1 << 30),
+                        compartilhado=True,
+                    )
+            elif backend == "redis":
+                url = redis_url
+                if url is None:
+                    servidor, _ = await fake_redis.iniciar()
+                    url = f"redis://127.0.0.1:{servidor.sockets[0].getsockname()[1]}/0"
+                # Prefixo único por execução: não colide com dados de um servidor real
+                execucao = uuid.uuid4().hex[:8]
+                await cenario(
+                    lambda ttl, n: RedisJobStore(url, ttl, n, 1 << 30, prefixo=f"verificacao:{execucao}:{ttl}:{n}:"),
+                    compartilhado=True,
+                )
+            else:
+                raise ValueError(f"backend desconhecido: {backend}")
+        except (AssertionError, RuntimeError) as e:
+            falhas += 1
+            print(f"    FALHOU: {e}")
+        finally:
+            if servidor is not None:
+                servidor.close()
+                await servidor.wait_closed()
+    return falhas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["memoria", "sqlite", "redis"])
+    parser.add_argument("--redis-url", help="servidor Redis real em vez do fake_redis")
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(verificar(args.backends, args.redis_url)) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+Backends de armazenamento de jobs do api.py.
+
+- MemoriaJobStore: dict em processo (um único worker)
+- SQLiteJobStore:  arquivo SQLite em modo WAL, compartilhado entre workers da mesma máquina
+- RedisJobStore:   qualquer servidor que fale o protocolo Redis (Redis, Valkey, KeyDB...)
+
+Jobs em "processing" criados por este worker ficam também em `locais`, com o
+asyncio.Event que acorda o long-polling; os demais workers enxergam o job pelo
+backend compartilhado e acompanham a mudança de status relendo o registro.
+"""
+from typing import Optional
+from collections import OrderedDict
+import asyncio
+import threading
+import sqlite3
+import json
+import uuid
+import time
+
+
+# Custo fixo estimado de um job (registro, Event, id) e razão aproximada entre
+# a memória dos dicts/strs Python e o tamanho do mesmo resultado em JSON
+JOB_BYTES_BASE    = 600
+JOB_FATOR_MEMORIA = 4
+
+
+def _para_json(obj):
+    """`default` do json: modelos (ex.: ResultadoRastreamento) viram dicts."""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"{type(obj).__name__} não é serializável em JSON")
+
+
+class Job:
+    """Registro de um job; __slots__ evita um __dict__ por instância."""
+
+    __slots__ = (
+        "job_id", "status", "_result", "error", "tentativas", "timings", "created_at", "concluido", "itens", "nbytes",
+        "corpo", "_pendente",
+    )
+
+    def __init__(self, job_id: str, itens: Optional[list] = None):
+        self.job_id     = job_id
+        self.status     = "processing"   # "processing" | "done" | "error"
+        self._result    = None
+        self._pendente  = False             # result ainda por decodificar de `corpo`
+        self.error      = None
+        self.tentativas = None              # chamadas à Jamef que o job precisou
+        self.timings    = None              # ms por fase (fila, auth, upstream, parse, total)
+        self.created_at = time.time()
+        self.concluido  = asyncio.Event()   # sinaliza a saída de "processing"
+        self.itens      = itens             # só em jobs de lote
+        self.nbytes     = JOB_BYTES_BASE
+        self.corpo      = None              # resposta de /status já serializada
+
+    @property
+    def result(self):
+        if self._pendente:
+            # Lido de um backend compartilhado: o resultado só existe dentro do corpo
+            self._result = json.loads(self.corpo)["result"]
+            self._pendente = False
+        return self._result
+
+    @result.setter
+    def result(self, valor):
+        self._result = valor
+        self._pendente = False
+
+    def to_json(self) -> str:
+        """Registro do job; com `corpo`, o resultado fica só nele (gravado ao lado)."""
+        dados = {
+            "job_id":     self.job_id,
+            "status":     self.status,
+            "error":      self.error,
+            "tentativas": self.tentativas,
+            "timings":    self.timings,
+            "created_at": self.created_at,
+            "itens":      self.itens,
+        }
+        if self.corpo is None:
+            dados["result"] = self.result
+        return json.dumps(dados, ensure_ascii=False, default=_para_json)
+
+    @classmethod
+    def from_json(cls, dados: str, corpo: Optional[bytes] = None) -> "Job":
+        d   = json.loads(dados)
+        job = cls(d["job_id"], d.get("itens"))
+        job.status     = d["status"]
+        job.error      = d.get("error")
+        job.tentativas = d.get("tentativas")
+        job.timings    = d.get("timings")
+        job.created_at = d["created_at"]
+        job.corpo      = corpo
+        if "result" in d:
+            job.result = d["result"]
+        else:
+            # Decodificado só se alguém pedir o result: /status devolve o corpo como está
+            job._pendente = corpo is not None
+        job.nbytes = len(dados) + len(corpo or b"")
+        if job.status != "processing":
+            job.concluido.set()
+        return job
+
+
+def estimar_bytes(job: Job) -> int:
+    """Estimativa da memória ocupada pelo job, a partir do tamanho do resultado em JSON."""
+    if job.corpo is not None:
+        # A resposta já serializada tem o tamanho do resultado em JSON: evita
+        # serializar tudo de novo no event loop (os bytes + os objetos do resultado)
+        return JOB_BYTES_BASE + (1 + JOB_FATOR_MEMORIA) * len(job.corpo)
+    if job.itens is not None:
+        conteudo = job.itens
+    elif job.result is not None:
+        conteudo = job.result
+    else:
+        return JOB_BYTES_BASE + len(job.error or "")
+    return JOB_BYTES_BASE + JOB_FATOR_MEMORIA * len(json.dumps(conteudo, ensure_ascii=False, default=_para_json))
+
+
+class JobStore:
+    """
+    Interface comum dos backends. `locais` guarda os jobs em andamento neste
+    worker para que o Event de conclusão e a deduplicação funcionem sem I/O.
+    """
+
+    compartilhado = False   # True se outros processos enxergam os mesmos jobs
+
+    def __init__(self, ttl: float, max_entradas: int, max_bytes: int):
+        self.ttl          = ttl
+        self.max_entradas = max_entradas
+        self.max_bytes    = max_bytes
+        self.locais: dict = {}
+        self.evictions    = 0
+
+    def local(self, job_id: Optional[str]) -> Optional[Job]:
+        """Job em andamento neste worker, sem consultar o backend."""
+        return self.locais.get(job_id)
+
+    async def criar(self, itens: Optional[list] = None) -> Job:
+        """Registra um novo job em "processing"."""
+        job = Job(str(uuid.uuid4()), itens)
+        self.locais[job.job_id] = job
+        await self._inserir(job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return self.locais.get(job_id) or await self._ler(job_id)
+
+    async def finalizar(
+        self, job: Job, status: str, result: Optional[dict] = None, error: Optional[str] = None,
+        corpo: Optional[bytes] = None,
+    ):
+        """
+        Grava o desfecho do job e acorda quem espera por ele. `corpo` é a
+        resposta de /status já serializada; os backends compartilhados a
+        gravam junto do registro e a devolvem pronta em get().
+        """
+        job.status = status
+        job.result = result
+        job.error  = error
+        job.corpo  = corpo
+        try:
+            await self._gravar(job)
+        finally:
+            self.locais.pop(job.job_id, None)
+            job.concluido.set()
+
+    async def salvar_progresso(self, job: Job):
+        """Persiste o estado parcial de um lote para os demais workers."""
+        await self._gravar(job)
+
+    async def limpar_expirados(self):
+        raise NotImplementedError
+
+    async def stats(self) -> dict:
+        raise NotImplementedError
+
+    async def fechar(self):
+        pass
+
+    async def _inserir(self, job: Job):
+        raise NotImplementedError
+
+    async def _ler(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    async def _gravar(self, job: Job):
+        raise NotImplementedError
+
+
+class MemoriaJobStore(JobStore):
+    """
+    Jobs em memória com limite de entradas e de bytes estimados.
+    Expira por idade (ordem de criação) e, ao estourar um limite, remove
+    primeiro os jobs finalizados há mais tempo; só então os mais antigos.
+    """
+
+    def __init__(self, ttl: float, max_entradas: int, max_bytes: int):
+        super().__init__(ttl, max_entradas, max_bytes)
+        self._jobs: OrderedDict        = OrderedDict()   # ordem de criação
+        self._finalizados: OrderedDict = OrderedDict()   # ordem de finalização
+        self.bytes = 0
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._jobs
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _inserir(self, job: Job):
+        self._jobs[job.job_id] = job
+        self.bytes += job.nbytes
+        self._aplicar_limites()
+
+    async def _ler(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _gravar(self, job: Job):
+        if job.status == "processing":
+            return   # progresso de lote: o objeto já é o próprio registro
+        nbytes = estimar_bytes(job)
+        # O job pode ter sido removido (expirado/evictado) enquanto consultava
+        if job.job_id in self._jobs:
+            self.bytes += nbytes - job.nbytes
+            self._finalizados[job.job_id] = job
+        job.nbytes = nbytes
+        self._aplicar_limites()
+
+    def remover(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self._finalizados.pop(job_id, None)
+            self.bytes -= job.nbytes
+
+    async def limpar_expirados(self):
+        """Remove jobs com mais de ttl segundos; só percorre os expirados."""
+        limite = time.time() - self.ttl
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if job.created_at > limite:
+                break
+            self.remover(job.job_id)
+
+    def _aplicar_limites(self):
+        while self._jobs and (len(self._jobs) > self.max_entradas or self.bytes > self.max_bytes):
+            origem = self._finalizados or self._jobs
+            self.remover(next(iter(origem)))
+            self.evictions += 1
+
+    async def stats(self) -> dict:
+        return {
+            "backend":      "memoria",
+            "entradas":     len(self._jobs),
+            "processing":   len(self._jobs) - len(self._finalizados),
+            "finalizados":  len(self._finalizados),
+            "bytes":        self.bytes,
+            "max_entradas": self.max_entradas,
+            "max_bytes":    self.max_bytes,
+            "evictions":    self.evictions,
+        }
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Jobs num arquivo SQLite em modo WAL: leitores não bloqueiam o escritor,
+    então vários workers uvicorn podem compartilhar o mesmo arquivo.
+    As chamadas rodam numa thread para não travar o event loop; os limites de
+    entradas e bytes são aplicados na varredura periódica de limpar_expirados().
+    """
+
+    compartilhado = True
+
+    def __init__(self, caminho: str, ttl: float, max_entradas: int, max_bytes: int):
+        super().__init__(ttl, max_entradas, max_bytes)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id      TEXT PRIMARY KEY,
+                status      TEXT NOT NULL,
+                created_at  REAL NOT NULL,
+                finished_at REAL,
+                nbytes      INTEGER NOT NULL,
+                dados       TEXT NOT NULL,
+                corpo       BLOB
+            )
+        """)
+        colunas = {linha[1] for linha in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "corpo" not in colunas:
+            # Arquivo criado por uma versão anterior
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN corpo BLOB")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)")
+
+    async def _executar(self, sql: str, params: tuple = ()) -> list:
+        def rodar():
+            with self._lock:
+                return self._conn.execute(sql, params).fetchall()
+        return await asyncio.to_thread(rodar)
+
+    async def _inserir(self, job: Job):
+        dados = job.to_json()
+        await self._executar(
+            "INSERT INTO jobs (job_id, status, created_at, nbytes, dados) VALUES (?, ?, ?, ?, ?)",
+            (job.job_id, job.status, job.created_at, len(dados), dados),
+        )
+
+    async def _ler(self, job_id: str) -> Optional[Job]:
+        linhas = await self._executar("SELECT dados, corpo FROM jobs WHERE job_id = ?", (job_id,))
+        return Job.from_json(*linhas[0]) if linhas else None
+
+    async def _gravar(self, job: Job):
+        dados = job.to_json()
+        finished_at = None if job.status == "processing" else time.time()
+        await self._executar(
+            "UPDATE jobs SET status = ?, finished_at = ?, nbytes = ?, dados = ?, corpo = ? WHERE job_id = ?",
+            (job.status, finished_at, len(dados) + len(job.corpo or b""), dados, job.corpo, job.job_id),
+        )
+
+    async def limpar_expirados(self):
+        """Remove jobs expirados e, acima dos limites, os finalizados há mais tempo."""
+        await self._executar("DELETE FROM jobs WHERE created_at <= ?", (time.time() - self.ttl,))
+        entradas, total = (await self._executar("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM jobs"))[0]
+        if entradas <= self.max_entradas and total <= self.max_bytes:
+            return
+        # Finalizados mais antigos primeiro; depois os em andamento mais antigos
+        linhas = await self._executar(
+            "SELECT job_id, nbytes FROM jobs ORDER BY finished_at IS NULL, finished_at, created_at"
+        )
+        remover = []
+        for job_id, nbytes in linhas:
+            if entradas <= self.max_entradas and total <= self.max_bytes:
+                break
+            remover.append(job_id)
+            entradas -= 1
+            total    -= nbytes
+        for i in range(0, len(remover), 500):
+            lote = remover[i:i + 500]
+            await self._executar(f"DELETE FROM jobs WHERE job_id IN ({','.join('?' * len(lote))})", tuple(lote))
+        self.evictions += len(remover)
+
+    async def stats(self) -> dict:
+        entradas, processing, total = (await self._executar(
+            "SELECT COUNT(*), COALESCE(SUM(status = 'processing'), 0), COALESCE(SUM(nbytes), 0) FROM jobs"
+        ))[0]
+        return {
+            "backend":      "sqlite",
+            "entradas":     entradas,
+            "processing":   processing,
+            "finalizados":  entradas - processing,
+            "bytes":        total,
+            "max_entradas": self.max_entradas,
+            "max_bytes":    self.max_bytes,
+            "evictions":    self.evictions,
+        }
+
+    async def fechar(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisJobStore(JobStore):
+    """
+    Jobs num servidor compatível com o protocolo Redis. Cada job é uma string
+    JSON com expiração (EX) igual ao TTL, seguida de uma quebra de linha e do
+    corpo de /status quando houver; um sorted set por created_at permite
+    aplicar o limite de entradas removendo os mais antigos; o limite de memória
+    fica a cargo do maxmemory do próprio servidor.
+    Requer o pacote opcional `redis` (pip install -r requirements-redis.txt).
+    """
+
+    compartilhado = True
+
+    def __init__(self, url: str, ttl: float, max_entradas: int, max_bytes: int, prefixo: str = "jamef:"):
+        super().__init__(ttl, max_entradas, max_bytes)
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("JOBS_BACKEND=redis requer o pacote `redis` (pip install -r requirements-redis.txt)") from e
+        self._redis   = redis.from_url(url)
+        self._prefixo = prefixo
+        self._indice  = f"{prefixo}jobs"
+
+    def _chave(self, job_id: str) -> str:
+        return f"{self._prefixo}job:{job_id}"
+
+    async def _inserir(self, job: Job):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._chave(job.job_id), job.to_json(), ex=int(self.ttl))
+            pipe.zadd(self._indice, {job.job_id: job.created_at})
+            await pipe.execute()
+
+    async def _ler(self, job_id: str) -> Optional[Job]:
+        valor = await self._redis.get(self._chave(job_id))
+        if not valor:
+            return None
+        if isinstance(valor, str):
+            valor = valor.encode()
+        # JSON serializado não contém quebra de linha literal: ela separa registro e corpo
+        dados, _, corpo = valor.partition(b"\n")
+        return Job.from_json(dados.decode(), corpo or None)
+
+    async def _gravar(self, job: Job):
+        valor = job.to_json().encode()
+        if job.corpo is not None:
+            valor += b"\n" + job.corpo
+        # KEEPTTL preservaria o prazo original, mas nem todo servidor suporta; recalcula
+        restante = max(1, int(job.created_at + self.ttl - time.time()))
+        await self._redis.set(self._chave(job.job_id), valor, ex=restante)
+
+    async def limpar_expirados(self):
+        """As chaves expiram sozinhas; aqui só o índice é podado e o limite aplicado."""
+        await self._redis.zremrangebyscore(self._indice, "-inf", time.time() - self.ttl)
+        excesso = await self._redis.zcard(self._indice) - self.max_entradas
+        if excesso > 0:
+            antigos = await self._redis.zpopmin(self._indice, excesso)
+            chaves  = [self._chave(jid.decode() if isinstance(jid, bytes) else jid) for jid, _ in antigos]
+            await self._redis.delete(*chaves)
+            self.evictions += len(antigos)
+
+    async def stats(self) -> dict:
+        return {
+            "backend":          "redis",
+            "entradas":         await self._redis.zcard(self._indice),
+            "processing_local": len(self.locais),
+            "max_entradas":     self.max_entradas,
+            "evictions":        self.evictions,
+        }
+
+    async def fechar(self):
+        await self._redis.aclose()
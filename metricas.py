@@ -0,0 +1,136 @@
+"""
+Métricas no formato de exposição de texto do Prometheus, sem dependências.
+
+Toda atualização acontece no event loop (uma única thread), então contadores,
+gauges e histogramas são só somas em dicts e listas: sem locks no caminho da
+requisição. O custo de formatar o texto fica todo no scrape de /metrics.
+
+Rótulos são passados como kwargs (`contador.inc(status="done")`); cada
+combinação de valores vira uma série própria.
+"""
+from typing import Callable, Optional
+from bisect import bisect_left
+
+
+# Latências das chamadas à Jamef, em segundos
+BUCKETS_LATENCIA = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _rotulos(chave: tuple, extra: str = "") -> str:
+    partes = [f'{k}="{v}"' for k, v in chave]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _numero(valor: float) -> str:
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Metrica:
+    tipo = ""
+
+    def __init__(self, nome: str, ajuda: str):
+        self.nome  = nome
+        self.ajuda = ajuda
+
+    def amostras(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        linhas += self.amostras()
+        return "\n".join(linhas)
+
+
+class Contador(Metrica):
+    """Valor que só cresce; `funcao` lê um contador que já existe em outro objeto."""
+
+    tipo = "counter"
+
+    def __init__(self, nome: str, ajuda: str, funcao: Optional[Callable[[], dict]] = None):
+        super().__init__(nome, ajuda)
+        self._valores: dict = {}
+        self._funcao = funcao
+
+    def inc(self, valor: float = 1, **rotulos):
+        chave = tuple(rotulos.items())
+        self._valores[chave] = self._valores.get(chave, 0) + valor
+
+    def valor(self, **rotulos) -> float:
+        return self._valores.get(tuple(rotulos.items()), 0)
+
+    def amostras(self) -> list[str]:
+        valores = self._valores
+        if self._funcao is not None:
+            # funcao() devolve {((rotulo, valor), ...): número}
+            valores = self._funcao()
+        return [f"{self.nome}{_rotulos(k)} {_numero(v)}" for k, v in valores.items()]
+
+
+class Gauge(Contador):
+    """Valor que sobe e desce (ex.: chamadas em andamento)."""
+
+    tipo = "gauge"
+
+    def dec(self, valor: float = 1, **rotulos):
+        self.inc(-valor, **rotulos)
+
+    def set(self, valor: float, **rotulos):
+        self._valores[tuple(rotulos.items())] = valor
+
+
+class Histograma(Metrica):
+    """Histograma de buckets fixos; observar() é um bisect e duas somas."""
+
+    tipo = "histogram"
+
+    def __init__(self, nome: str, ajuda: str, buckets: tuple = BUCKETS_LATENCIA):
+        super().__init__(nome, ajuda)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict = {}   # chave de rótulos -> [contagens por bucket..., +Inf, soma]
+
+    def observar(self, valor: float, **rotulos):
+        chave = tuple(rotulos.items())
+        serie = self._series.get(chave)
+        if serie is None:
+            serie = self._series[chave] = [0] * (len(self.buckets) + 1) + [0.0]
+        serie[bisect_left(self.buckets, valor)] += 1
+        serie[-1] += valor
+
+    def amostras(self) -> list[str]:
+        linhas = []
+        for chave, serie in self._series.items():
+            acumulado = 0
+            for limite, n in zip(self.buckets + (float("inf"),), serie):
+                acumulado += n
+                le = 'le="%s"' % _numero(limite)
+                linhas.append(f"{self.nome}_bucket{_rotulos(chave, le)} {acumulado}")
+            linhas.append(f"{self.nome}_sum{_rotulos(chave)} {_numero(serie[-1])}")
+            linhas.append(f"{self.nome}_count{_rotulos(chave)} {acumulado}")
+        return linhas
+
+
+class Registro:
+    """Conjunto de métricas expostas juntas em /metrics."""
+
+    def __init__(self):
+        self.metricas: list[Metrica] = []
+
+    def _registrar(self, metrica):
+        self.metricas.append(metrica)
+        return metrica
+
+    def contador(self, nome: str, ajuda: str, funcao: Optional[Callable[[], dict]] = None) -> Contador:
+        return self._registrar(Contador(nome, ajuda, funcao))
+
+    def gauge(self, nome: str, ajuda: str, funcao: Optional[Callable[[], dict]] = None) -> Gauge:
+        return self._registrar(Gauge(nome, ajuda, funcao))
+
+    def histograma(self, nome: str, ajuda: str, buckets: tuple = BUCKETS_LATENCIA) -> Histograma:
+        return self._registrar(Histograma(nome, ajuda, buckets))
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self.metricas) + "\n"